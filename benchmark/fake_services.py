@@ -0,0 +1,155 @@
+"""Local stand-ins for Plex, Radarr, TMDb and OMDb used by the benchmark.
+
+All four services are served from one HTTP server on 127.0.0.1, routed by
+path prefix:
+
+    /plex/...   Plex Media Server (XML)
+    /radarr/... Radarr v3 API
+    /tmdb/3/... TMDb v3 API
+    /omdb/      OMDb API
+
+Every response is delayed by a configurable latency so the benchmark can
+model slow upstreams, and requests are counted per service.
+"""
+
+import json, re, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GENRES = ["Drama", "Horror", "Animation", "Science Fiction", "Comedy", "TV Movie", "Action"]
+
+
+def tmdb_movie(tmdb_id):
+    """Deterministic synthetic TMDb details for a movie id."""
+    tmdb_id = int(tmdb_id)
+    genres = [{"id": i, "name": GENRES[(tmdb_id + i) % len(GENRES)]} for i in range(1 + tmdb_id % 2)]
+    if tmdb_id % 7 == 0:
+        # Every seventh movie has gaps that only OMDb can fill.
+        genres = []
+    return {
+        "id": tmdb_id,
+        "title": f"Benchmark Movie {tmdb_id}",
+        "original_title": f"Benchmark Movie {tmdb_id}",
+        "release_date": f"{1980 + tmdb_id % 40}-01-01",
+        "belongs_to_collection": {"id": tmdb_id // 3, "name": f"Benchmark Collection {tmdb_id // 3}"} if tmdb_id % 3 == 0 else None,
+        "production_companies": [] if tmdb_id % 7 == 0 else [{"id": 1, "name": "Benchmark Pictures"}],
+        "production_countries": [{"iso_3166_1": "US", "name": "United States of America"}],
+        "spoken_languages": [{"iso_639_1": "en", "english_name": "English", "name": "English"}],
+        "genres": genres,
+    }
+
+
+def omdb_movie(imdb_id):
+    return {"Response": "True", "imdbID": imdb_id, "Production": "N/A", "Country": "USA",
+            "Language": "English", "Genre": "Drama, Thriller"}
+
+
+class FakeServices:
+    """Serves the stand-in APIs from a background thread.
+
+    Arguments:
+        latency (float): Seconds added to every response.
+        libraries (list): Plex libraries as dicts with id, type, title and path.
+    """
+
+    def __init__(self, latency=0.0, libraries=()):
+        self.latency = latency
+        self.libraries = list(libraries)
+        self.requests = Counter()
+        self.refreshes = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        # Clients disconnecting when the daemon is stopped are expected, not worth a traceback.
+        self._server.handle_error = lambda request, client_address: None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _count(self, service, path):
+        with self._lock:
+            self.requests[service] += 1
+            if service == "plex" and "/refresh" in path:
+                self.refreshes.append(path)
+
+    def _plex(self, path, query):
+        if path in ("", "/"):
+            return ('<MediaContainer size="0" friendlyName="benchmark" machineIdentifier="benchmark" '
+                    'version="1.32.0.0" platform="Linux" myPlex="0"/>')
+        if path == "/library/sections":
+            directories = "".join(
+                f'<Directory key="{lib["id"]}" type="{lib["type"]}" title="{lib["title"]}" agent="tv.plex.agents.{lib["type"]}" '
+                f'scanner="Plex {lib["type"].title()}" language="en-US" uuid="bench-{lib["id"]}" refreshing="0">'
+                f'<Location id="{lib["id"]}" path="{lib["path"]}"/></Directory>'
+                for lib in self.libraries
+            )
+            return f'<MediaContainer size="{len(self.libraries)}">{directories}</MediaContainer>'
+        match = re.match(r"^/library/sections/(\d+)/all$", path)
+        if match and "includeMeta" in query:
+            # Just enough filter metadata for plexapi to accept an addedAt search.
+            lib = next((lib for lib in self.libraries if str(lib["id"]) == match.group(1)), None)
+            if lib:
+                type_id = 1 if lib["type"] == "movie" else 2
+                return (f'<MediaContainer size="0" totalSize="0" offset="0"><Meta>'
+                        f'<Type key="/library/sections/{lib["id"]}/all?type={type_id}" type="{lib["type"]}" title="{lib["title"]}" active="1">'
+                        '<Field key="addedAt" title="Date Added" type="date"/></Type>'
+                        '<FieldType type="date"><Operator key="&gt;&gt;=" title="is after"/>'
+                        '<Operator key="&lt;&lt;=" title="is before"/></FieldType>'
+                        '</Meta></MediaContainer>')
+        return '<MediaContainer size="0" totalSize="0" offset="0"/>'
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, body, content_type):
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _route(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                service, _, rest = url.path.lstrip("/").partition("/")
+                rest = "/" + rest
+                services._count(service, rest)
+                if services.latency:
+                    time.sleep(services.latency)
+                if service == "plex":
+                    return self._reply(200, services._plex(rest.rstrip("/") or "/", query), "text/xml")
+                if service == "radarr" and re.match(r"^/api/v3/movie/\d+$", rest):
+                    return self._reply(200, "{}", "application/json")
+                if service == "tmdb" and rest == "/3/search/movie":
+                    match = re.match(r"^Benchmark Movie (\d+)$", query.get("query", [""])[0])
+                    results = [tmdb_movie(match.group(1))] if match else []
+                    return self._reply(200, json.dumps({"page": 1, "results": results, "total_results": len(results)}), "application/json")
+                match = re.match(r"^/3/movie/(\d+)/external_ids$", rest)
+                if service == "tmdb" and match:
+                    return self._reply(200, json.dumps({"id": int(match.group(1)), "imdb_id": f"tt{int(match.group(1)):07d}"}), "application/json")
+                match = re.match(r"^/3/movie/(\d+)$", rest)
+                if service == "tmdb" and match:
+                    return self._reply(200, json.dumps(tmdb_movie(match.group(1))), "application/json")
+                if service == "omdb":
+                    return self._reply(200, json.dumps(omdb_movie(query.get("i", [""])[0])), "application/json")
+                self._reply(404, "{}", "application/json")
+
+            do_GET = do_DELETE = do_POST = do_PUT = _route
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
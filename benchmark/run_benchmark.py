@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Replay a burst of Sonarr/Radarr webhooks through media_processor and measure it.
+
+The benchmark builds a throwaway workspace with its own config.yaml, points
+Plex, Radarr, TMDb and OMDb at local stand-ins (see fake_services.py), uses
+stub_convert.py in place of the Sickbeard automator and local directories as
+rclone remotes, then starts `media_processor.py` in that workspace and drops
+the whole burst into its spool at once. It reports jobs per minute,
+end-to-end and per-stage latency percentiles, the time steps spent waiting
+for a worker pool, and how many requests each service received.
+
+    python benchmark/run_benchmark.py --episodes 24 --movies 10 --uhd-movies 2
+    python benchmark/run_benchmark.py --replay recorded_webhooks/ --json bench.json
+
+Replayed payloads are JSON files whose name or parent directory contains
+"sonarr", "uhd_radarr" or "radarr". Files they reference are created as
+placeholders under the workspace.
+"""
+
+import argparse, glob, json, os, shutil, signal, sqlite3, subprocess, sys, tempfile, time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, REPO)
+
+from fake_services import FakeServices
+from job_spool import spool_event
+
+
+def synthetic_events(episodes, movies, uhd_movies):
+    events = []
+    for n in range(1, episodes + 1):
+        events.append(("sonarr", {
+            "seriestitle": "Benchmark Show", "season_number": 1, "ep_number": n,
+            "epidodepath": f"/TV/Benchmark Show/Season 01/Benchmark Show - S01E{n:02d}.mkv",
+        }))
+    for n in range(1, movies + uhd_movies + 1):
+        kind = "radarr" if n <= movies else "uhd_radarr"
+        events.append((kind, {
+            "movietitle": f"Benchmark Movie {n}", "movieid": n, "tmdbid": n, "imdbid": f"tt{n:07d}",
+            "moviepath": f"/Downloads/{kind}/Benchmark Movie {n}/Benchmark Movie {n}.mkv",
+        }))
+    return events
+
+
+def replay_events(directory):
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, "**", "*.json"), recursive=True)):
+        name = os.path.relpath(path, directory).lower()
+        kind = "sonarr" if "sonarr" in name else "uhd_radarr" if "uhd" in name else "radarr" if "radarr" in name else None
+        if kind is None:
+            print(f"Skipping {path}: cannot tell whether it is a Sonarr or Radarr payload")
+            continue
+        with open(path) as f:
+            events.append((kind, json.load(f)))
+    return events
+
+
+def build_workspace(work, services, remotes, overrides):
+    base = os.path.join(work, "media")
+    plex_base = "/plex"
+    for directory in ["config", "data", "logs", base] + remotes:
+        os.makedirs(directory if os.path.isabs(directory) else os.path.join(work, directory), exist_ok=True)
+    rclone = shutil.which("rclone") or os.path.join(HERE, "stub_rclone.py")
+    config = {
+        "plex_server": f"{services.url}/plex", "plex_token": "benchmark",
+        "rclone_log_file": os.path.join(work, "logs", "rclone-"),
+        "radarr_url": f"{services.url}/radarr", "uhd_radarr_url": f"{services.url}/radarr",
+        "radarr_api": "benchmark", "uhd_radarr_api": "benchmark",
+        "sickbeard_path": os.path.join(HERE, "stub_convert.py"), "python_path": sys.executable,
+        "rclone_state": os.path.join(work, "data", "rclone_state.json"), "rclone_path": rclone,
+        "tmdb_api": "benchmark", "omdb_api": "benchmark",
+        "tmdb_url": f"{services.url}/tmdb/3", "omdb_url": f"{services.url}/omdb/",
+        "plex_base_path": plex_base, "uhd_base_path": "4K Sorted", "movie_base_path": "Sorted Movies",
+        "base_path": base, "remotes": remotes, "metrics_port": "",
+        # Jobs finish only once their Plex refresh is sent, keep the coalescing window short so it does not dominate
+        "plex_refresh_window": 1, "plex_refresh_max_delay": 5,
+        "sorting_rules": os.path.join(REPO, "config", "sorting_rules.yaml"),
+        "libraries": [{"id": lib["id"], "path": lib["path"]} for lib in services.libraries],
+    }
+    config.update(overrides)
+    with open(os.path.join(work, "config", "config.yaml"), "w") as f:
+        json.dump(config, f, indent=2)  # JSON is valid YAML
+    return base
+
+
+def materialize(events, base, file_size):
+    for kind, payload in events:
+        relative = payload["epidodepath"] if kind == "sonarr" else payload["moviepath"]
+        path = os.path.join(base, relative.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(file_size)
+
+
+def wait_for_jobs(db_path, expected, timeout, daemon):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if daemon.poll() is not None:
+            raise RuntimeError(f"media_processor exited with status {daemon.returncode}")
+        if os.path.exists(db_path):
+            with sqlite3.connect(db_path, timeout=30) as db:
+                counts = dict(db.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+            if sum(counts.values()) >= expected and not counts.get("running"):
+                return counts
+        time.sleep(0.2)
+    raise TimeoutError(f"Jobs still running after {timeout}s")
+
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"count": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]}
+
+
+def summarize(work, started, counts, services):
+    with sqlite3.connect(os.path.join(work, "data", "jobs.db")) as db:
+        rows = db.execute("SELECT kind, created, updated FROM jobs WHERE status = 'done'").fetchall()
+    finished = max((updated for _, _, updated in rows), default=started)
+    stages = defaultdict(list)
+    metrics_log = os.path.join(work, "data", "metrics.jsonl")
+    if os.path.exists(metrics_log):
+        with open(metrics_log) as f:
+            for line in f:
+                event = json.loads(line)
+                stages[event["stage"]].append(event["seconds"])
+    elapsed = max(finished - started, 1e-9)
+    return {
+        "jobs": counts,
+        "elapsed_seconds": round(elapsed, 2),
+        "jobs_per_minute": round(len(rows) / elapsed * 60, 2),
+        "job_latency": percentiles([updated - started for _, _, updated in rows]) if rows else {},
+        "stages": {stage: percentiles(values) for stage, values in sorted(stages.items()) if not stage.endswith("_wait")},
+        "pool_wait": {stage: dict(percentiles(values), total=round(sum(values), 2))
+                      for stage, values in sorted(stages.items()) if stage.endswith("_wait")},
+        "service_requests": dict(services.requests),
+        "plex_refreshes": len(services.refreshes),
+    }
+
+
+def print_report(report):
+    print(f"\nJobs: {report['jobs']}  elapsed {report['elapsed_seconds']}s  {report['jobs_per_minute']} jobs/min")
+    rows = [("job (end to end)", report["job_latency"])] if report["job_latency"] else []
+    rows += list(report["stages"].items()) + list(report["pool_wait"].items())
+    print(f"\n{'stage':<24}{'count':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for stage, p in rows:
+        print(f"{stage:<24}{p['count']:>7}{p['p50']:>10.3f}{p['p90']:>10.3f}{p['p99']:>10.3f}{p['max']:>10.3f}")
+    print(f"\nService requests: {report['service_requests']}  Plex partial refreshes: {report['plex_refreshes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--episodes", type=int, default=24, help="Synthetic TV episodes in the burst")
+    parser.add_argument("--movies", type=int, default=10, help="Synthetic HD movies in the burst")
+    parser.add_argument("--uhd-movies", type=int, default=2, help="Synthetic UHD movies in the burst")
+    parser.add_argument("--replay", help="Directory of recorded webhook payloads to replay instead")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every fake service response")
+    parser.add_argument("--convert-seconds", type=float, default=0.5, help="Seconds the stub converter takes per file")
+    parser.add_argument("--upload-bps", type=float, default=0, help="Throttle for the stub rclone, in bytes/s")
+    parser.add_argument("--file-size", type=int, default=1 << 20, help="Size of each placeholder media file")
+    parser.add_argument("--remotes", type=int, default=3, help="Number of local rclone remotes")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a config.yaml key")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--workdir", help="Keep the workspace here instead of a temporary directory, must be empty")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    events = replay_events(args.replay) if args.replay else synthetic_events(args.episodes, args.movies, args.uhd_movies)
+    if not events:
+        parser.error("No events to replay")
+    if args.workdir and os.path.isdir(args.workdir) and os.listdir(args.workdir):
+        # An old jobs.db would count its jobs toward this run's
+        parser.error(f"--workdir {args.workdir} is not empty")
+
+    work = args.workdir or tempfile.mkdtemp(prefix="media-bench-")
+    libraries = [
+        {"id": 1, "type": "show", "title": "TV", "path": "/plex/TV"},
+        {"id": 2, "type": "movie", "title": "Movies", "path": "/plex/Sorted Movies"},
+    ]
+    services = FakeServices(args.latency, libraries).start()
+    remotes = [os.path.join(work, "remotes", f"r{n}") for n in range(1, args.remotes + 1)]
+    overrides = dict(item.split("=", 1) for item in args.set)
+    base = build_workspace(work, services, remotes, overrides)
+    materialize(events, base, args.file_size)
+
+    env = dict(os.environ, BENCH_CONVERT_SECONDS=str(args.convert_seconds), BENCH_UPLOAD_BPS=str(args.upload_bps or ""))
+    with open(os.path.join(work, "logs", "media_processor.log"), "w") as log:
+        daemon = subprocess.Popen([sys.executable, os.path.join(REPO, "media_processor.py")], cwd=work, env=env,
+                                  stdout=log, stderr=subprocess.STDOUT)
+        try:
+            time.sleep(1)
+            started = time.time()
+            for kind, payload in events:
+                spool_event(os.path.join(work, "data", "spool"), kind, payload)
+            counts = wait_for_jobs(os.path.join(work, "data", "jobs.db"), len(events), args.timeout, daemon)
+        finally:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait(10)
+            services.stop()
+
+    report = summarize(work, started, counts, services)
+    print_report(report)
+    print(f"\nWorkspace: {work}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Measure how long the daemon's modules take to import, and fail when it regresses.
+
+Every restart of media_processor pays this before it handles a single job.
+The benchmark imports every project module media_processor.py imports, in a
+fresh interpreter each run, with `python -X importtime`, and reports the
+median wall time and the slowest imports. It exits with status 1 when the
+median exceeds --budget or when a module that should only be imported on
+first use (the Plex, Radarr and TMDb clients, pandas) is imported at startup.
+
+    python benchmark/startup_time.py
+    python benchmark/startup_time.py --runs 20 --budget 0.3 --json startup.json
+"""
+
+import argparse, ast, json, os, statistics, subprocess, sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+# Imported lazily on purpose, see rr_operations, plex_operations and movie_sorting
+LAZY = ("plexapi", "pyarr", "tmdbv3api", "pandas")
+
+
+def daemon_modules():
+    """Return the project modules media_processor.py imports, read from its source."""
+    with open(os.path.join(REPO, "media_processor.py")) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        names = [node.module] if isinstance(node, ast.ImportFrom) and node.module else \
+            [alias.name for alias in node.names] if isinstance(node, ast.Import) else []
+        for name in names:
+            if os.path.exists(os.path.join(REPO, f"{name}.py")) and name not in modules:
+                modules.append(name)
+    return modules
+
+
+def measure(modules):
+    """Import modules in a fresh interpreter.
+
+    Returns:
+        tuple: The wall time in seconds, the cumulative microseconds of each top-level
+            import, and which of LAZY ended up imported.
+    """
+    script = ("import sys, time; started = time.perf_counter()\n"
+              f"for name in {modules!r}: __import__(name)\n"
+              "print(time.perf_counter() - started)\n"
+              f"print(','.join(m for m in {LAZY!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=REPO,
+                            capture_output=True, text=True, check=True)
+    seconds, lazy = result.stdout.splitlines()[:2]
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only top-level entries, nested imports are already counted in their parent
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports[name.strip()] = int(cumulative)
+    return float(seconds), imports, [m for m in lazy.split(",") if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Fresh interpreters to time")
+    parser.add_argument("--budget", type=float, default=0.5, help="Most seconds the median import may take")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    modules = daemon_modules()
+    times, slowest, lazy = [], {}, set()
+    for _ in range(args.runs):
+        seconds, imports, imported = measure(modules)
+        times.append(seconds)
+        lazy.update(imported)
+        for name, micros in imports.items():
+            slowest.setdefault(name, []).append(micros)
+
+    report = {
+        "modules": modules,
+        "runs": args.runs,
+        "median_seconds": round(statistics.median(times), 4),
+        "max_seconds": round(max(times), 4),
+        "slowest_imports": {name: round(statistics.median(micros) / 1e6, 4) for name, micros in
+                            sorted(slowest.items(), key=lambda item: -statistics.median(item[1]))[:args.top]},
+        "lazy_imported": sorted(lazy),
+    }
+    print(f"Imported {len(modules)} modules in {report['median_seconds']}s median, {report['max_seconds']}s max "
+          f"over {args.runs} runs (budget {args.budget}s)")
+    print(f"\n{'import':<32}{'seconds':>10}")
+    for name, seconds in report["slowest_imports"].items():
+        print(f"{name:<32}{seconds:>10.4f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if lazy:
+        print(f"\nImported at startup but should be loaded on first use: {', '.join(sorted(lazy))}")
+        failed = True
+    if report["median_seconds"] > args.budget:
+        print(f"\nStartup imports took {report['median_seconds']}s, over the {args.budget}s budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
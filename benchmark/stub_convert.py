@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""Stand-in for the Sickbeard MP4 automator: `stub_convert.py -i <file> -a`.
+
+Sleeps for BENCH_CONVERT_SECONDS to model a transcode, then replaces the
+input with an .m4v next to it, like the automator does.
+"""
+
+import argparse, os, time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", dest="input", required=True)
+parser.add_argument("-a", action="store_true")
+args = parser.parse_args()
+
+time.sleep(float(os.environ.get("BENCH_CONVERT_SECONDS", "0")))
+base, ext = os.path.splitext(args.input)
+os.replace(args.input, f"{base}.m4v")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Stand-in for `rclone move` and `rclone lsf` when rclone is not installed.
+
+Remotes are plain local directories, as with rclone's local backend. Only
+the options media_uploader and movie_resort pass are understood. BENCH_UPLOAD_BPS, if set,
+throttles the move to that many bytes per second.
+"""
+
+import argparse, os, shutil, sys, time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("command", choices=["move", "lsf"])
+parser.add_argument("source")
+parser.add_argument("destination", nargs="?")
+parser.add_argument("-v", action="store_true")
+parser.add_argument("-R", action="store_true")
+parser.add_argument("--dirs-only", action="store_true")
+parser.add_argument("--stats")
+parser.add_argument("--log-file")
+parser.add_argument("--files-from")
+parser.add_argument("--delete-empty-src-dirs", action="store_true")
+args = parser.parse_args()
+
+if args.command == "lsf":
+    if not os.path.isdir(args.source):
+        print(f"{args.source}: directory not found", file=sys.stderr)
+        sys.exit(3)
+    for directory, subdirs, files in os.walk(args.source):
+        for name in subdirs + ([] if args.dirs_only else files):
+            relative = os.path.relpath(os.path.join(directory, name), args.source)
+            print(relative + "/" if name in subdirs else relative)
+        if not args.R:
+            break
+    sys.exit(0)
+
+if args.files_from:
+    with open(args.files_from) as f:
+        moves = [(os.path.join(args.source, name), os.path.join(args.destination, name)) for name in f.read().split("\n") if name]
+elif os.path.isdir(args.source):
+    # Like rclone, moving a directory moves its contents into the destination directory
+    moves = [(os.path.join(args.source, name), os.path.join(args.destination, name)) for name in os.listdir(args.source)]
+else:
+    moves = [(args.source, os.path.join(args.destination, os.path.basename(args.source)))]
+
+bps = float(os.environ.get("BENCH_UPLOAD_BPS") or 0)
+for source, destination in moves:
+    if not os.path.exists(source):
+        print(f"{source}: not found", file=sys.stderr)
+        sys.exit(3)
+    if bps:
+        time.sleep(os.path.getsize(source) / bps)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.move(source, destination)
+
+if args.delete_empty_src_dirs and os.path.isdir(args.source) and not os.listdir(args.source):
+    os.rmdir(args.source)
@@ -0,0 +1,334 @@
+"""A convert job queue on the shared base_path mount, so several hosts can transcode at once.
+
+The coordinator (media_processor.py) puts every conversion in the queue and
+any number of workers (media_processor.py --worker, on any host that mounts
+base_path) take them out. The queue is a directory, like the webhook spool:
+
+    pending/<task>.json           waiting for a worker
+    claimed/<task>.<token>.json   being converted; the worker touches it every heartbeat
+    done/<task>.json              the result, written by the worker for the coordinator
+
+Every hand-over is an atomic rename within one filesystem, so only one
+worker wins a claim. A claimed task is a lease: the coordinator watches each
+claimed file's modification time with its own clock, so host clocks do not
+need to agree, and puts the task back in pending/ when the file has not been
+touched for `lease` seconds because its worker died or lost the mount.
+Every claim renames the task to a new random token, which only its worker
+knows, so a stalled worker that comes back after its task was requeued and
+claimed again cannot heartbeat or finish the new claim. Cancelling a task
+removes its file, and a worker whose claimed file is gone, because the lease
+expired or the job was cancelled, stops its conversion.
+
+Tasks are named after their job, so a restarted coordinator picks up its
+queued and finished conversions instead of converting them twice. Paths in
+tasks are relative to base_path, since each host may mount it elsewhere.
+"""
+
+import json, os, socket, threading, time, uuid
+from collections import namedtuple
+from concurrent.futures import Future
+from job_cancel import Cancellation, JobCancelled
+
+Task = namedtuple("Task", ["job_class", "queued_at", "name", "data", "claimed"], defaults=[None])
+
+# Results nobody asks for, from jobs that were since dropped, are removed after this long
+_STALE_RESULT = 24 * 3600
+
+
+def _write(path, data):
+    """Write JSON to a hidden temporary name next to path and rename it into place."""
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def _read(path):
+    """Return the JSON in path, or None if it is gone or not completely written."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _tasks(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".json") and not name.startswith("."))
+
+
+def _task_name(claimed):
+    """Return the task file name of a claimed/<task>.<token>.json name."""
+    return claimed.rsplit(".", 2)[0] + ".json"
+
+
+class _QueueDirectory:
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending_dir = os.path.join(directory, "pending")
+        self.claimed_dir = os.path.join(directory, "claimed")
+        self.done_dir = os.path.join(directory, "done")
+        for path in (self.pending_dir, self.claimed_dir, self.done_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def _claims(self, name):
+        """Return the paths in claimed/ of a task, normally at most one."""
+        return [os.path.join(self.claimed_dir, claimed) for claimed in _tasks(self.claimed_dir) if _task_name(claimed) == name]
+
+    def _remove(self, name):
+        """Remove a task from every directory of the queue."""
+        for path in [os.path.join(self.pending_dir, name), os.path.join(self.done_dir, name)] + self._claims(name):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ConvertQueue(_QueueDirectory):
+    """The coordinator's side: queues conversions and collects their results.
+
+    Arguments:
+        directory (str): The queue directory on the shared mount.
+        lease (float): Seconds a worker may go without a heartbeat before its task is requeued.
+        poll_interval (float): Seconds between checks for results and expired leases.
+    """
+
+    def __init__(self, directory, lease=60, poll_interval=1):
+        super().__init__(directory)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._futures = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="convert-queue", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, task_id, path, job_class):
+        """Queue the conversion of a file.
+
+        Arguments:
+            task_id (str): A name unique to the job, such as its journal id.
+            path (str): The file to convert, relative to base_path.
+            job_class (str): The job's scheduling class, see PriorityScheduler.
+
+        Returns:
+            Future: Completes with the converted file's path relative to base_path, or
+                with a RuntimeError if the conversion failed.
+        """
+        name = f"{task_id}.json"
+        future = Future()
+        with self._lock:
+            self._futures[name] = future
+        # A task queued or finished before a restart is still in the queue, do not convert it twice
+        if not (any(os.path.exists(os.path.join(d, name)) for d in (self.pending_dir, self.done_dir)) or self._claims(name)):
+            _write(os.path.join(self.pending_dir, name),
+                   {"id": str(task_id), "path": path, "class": job_class, "queued_at": time.time()})
+        return future
+
+    def cancel(self, task_id, reason):
+        """Withdraw a task. A worker converting it notices at its next heartbeat and stops."""
+        name = f"{task_id}.json"
+        with self._lock:
+            future = self._futures.pop(name, None)
+        self._remove(name)
+        if future is not None:
+            future.set_exception(JobCancelled(reason))
+
+    def _run(self):
+        while True:
+            try:
+                self._collect()
+                self._expire()
+            except OSError as e:
+                print(f"Cannot read the convert queue {self.directory}: {e}")
+            time.sleep(self.poll_interval)
+
+    def _collect(self):
+        for name in _tasks(self.done_dir):
+            path = os.path.join(self.done_dir, name)
+            with self._lock:
+                future = self._futures.pop(name, None)
+            if future is None:
+                try:
+                    if time.time() - os.path.getmtime(path) > _STALE_RESULT:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            result = _read(path)
+            if result is None:
+                with self._lock:
+                    self._futures[name] = future
+                continue
+            # The task may have been requeued while its first worker was still finishing
+            self._remove(name)
+            if result.get("ok"):
+                future.set_result(result["converted_path"])
+            else:
+                future.set_exception(RuntimeError(f"Conversion failed on {result.get('worker')}: {result.get('error')}"))
+
+    def _expire(self):
+        now = time.monotonic()
+        claimed = set(_tasks(self.claimed_dir))
+        for name in list(self._seen):
+            if name not in claimed:
+                del self._seen[name]
+        for name in claimed:
+            path = os.path.join(self.claimed_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen = self._seen.get(name)
+            if seen is None or seen[0] != mtime:
+                self._seen[name] = (mtime, now)
+            elif now - seen[1] > self.lease:
+                try:
+                    os.rename(path, os.path.join(self.pending_dir, _task_name(name)))
+                except FileNotFoundError:
+                    continue
+                del self._seen[name]
+                print(f"Convert task {_task_name(name)[:-5]} missed its heartbeat for {self.lease}s, requeued")
+
+    def gauges(self):
+        """Return (name, labels, value) tuples for JobMetrics."""
+        samples = []
+        for state, directory in (("pending", self.pending_dir), ("claimed", self.claimed_dir)):
+            try:
+                samples.append(("convert_queue_tasks", {"state": state}, len(_tasks(directory))))
+            except OSError:
+                pass
+        return samples
+
+
+class ConvertWorker(_QueueDirectory):
+    """The worker's side: claims tasks, converts them and reports the results.
+
+    Arguments:
+        directory (str): The queue directory on the shared mount.
+        base_path (str): Where this host mounts base_path.
+        convert (callable): Called with the absolute path of a file and the task's Cancellation,
+            returns the converted file's absolute path. Raising marks the task failed.
+        slots (int): Tasks converted at once.
+        lease (float): The coordinator's lease; the worker heartbeats four times per lease.
+        scheduler (PriorityScheduler): Picks which pending task to claim next and caps
+            the tasks of each class claimed across all workers at once (its "convert" limits).
+        poll_interval (float): Seconds between looks at an empty queue.
+    """
+
+    def __init__(self, directory, base_path, convert, slots, lease, scheduler, poll_interval=2):
+        super().__init__(directory)
+        self.base_path = base_path
+        self.convert = convert
+        self.slots = slots
+        self.heartbeat = lease / 4
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self._claim_lock = threading.Lock()
+        self._slots_lock = threading.Lock()
+        self._alive = set()
+
+    def start(self):
+        """Start the worker threads in the background."""
+        self.set_slots(self.slots)
+
+    def set_slots(self, slots):
+        """Change how many tasks are converted at once. A slot taken away stops after its current task."""
+        with self._slots_lock:
+            self.slots = slots
+            for slot in range(slots):
+                if slot not in self._alive:
+                    self._alive.add(slot)
+                    threading.Thread(target=self._run, args=(slot,), name=f"convert-worker-{slot}", daemon=True).start()
+
+    def run(self):
+        """Convert tasks until the process is stopped."""
+        self.start()
+        print(f"Convert worker {self.name} taking up to {self.slots} task(s) from {self.directory}")
+        threading.Event().wait()
+
+    def _run(self, slot):
+        while True:
+            with self._slots_lock:
+                if slot >= self.slots:
+                    self._alive.discard(slot)
+                    return
+            try:
+                task = self.claim()
+            except OSError as e:
+                print(f"Cannot read the convert queue {self.directory}: {e}")
+                task = None
+            if task is None:
+                time.sleep(self.poll_interval)
+                continue
+            self._process(task)
+
+    def claim(self):
+        """Claim the pending task the scheduler picks. Returns a Task, or None if there is nothing to do."""
+        # One claim at a time per host keeps this host's own threads from racing for the same task
+        with self._claim_lock:
+            running = {}
+            for name in _tasks(self.claimed_dir):
+                data = _read(os.path.join(self.claimed_dir, name))
+                if data is not None:
+                    key = ("convert", data["class"])
+                    running[key] = running.get(key, 0) + 1
+            waiting = []
+            for name in _tasks(self.pending_dir):
+                data = _read(os.path.join(self.pending_dir, name))
+                if data is not None:
+                    waiting.append(Task(data["class"], data["queued_at"], name, data))
+            waiting.sort(key=lambda task: task.queued_at)
+            while waiting:
+                task = self.scheduler.pick("convert", waiting, running, time.time())
+                if task is None:
+                    return None
+                claimed = f"{task.name[:-5]}.{uuid.uuid4().hex}.json"
+                try:
+                    os.rename(os.path.join(self.pending_dir, task.name), os.path.join(self.claimed_dir, claimed))
+                    return task._replace(claimed=claimed)
+                except FileNotFoundError:
+                    # Another worker was faster
+                    waiting.remove(task)
+            return None
+
+    def _heartbeat(self, path, stop, cancellation):
+        while not stop.wait(self.heartbeat):
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                cancellation.cancel(f"lost the lease on {_task_name(os.path.basename(path))[:-5]}, it expired or was cancelled")
+                return
+            except OSError as e:
+                print(f"Heartbeat for {_task_name(os.path.basename(path))[:-5]} failed: {e}")
+
+    def _process(self, task):
+        claimed = os.path.join(self.claimed_dir, task.claimed)
+        stop, cancellation = threading.Event(), Cancellation()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(claimed, stop, cancellation), daemon=True)
+        heartbeat.start()
+        result = {"id": task.data["id"], "worker": self.name}
+        print(f"Converting task {task.data['id']}: {task.data['path']}")
+        try:
+            converted = self.convert(os.path.join(self.base_path, task.data["path"]), cancellation)
+            result.update(ok=True, converted_path=os.path.relpath(converted, self.base_path))
+        except Exception as e:
+            result.update(ok=False, error=str(e))
+        finally:
+            stop.set()
+            heartbeat.join()
+        if not cancellation.cancelled and not os.path.exists(claimed):
+            cancellation.cancel(f"lost the lease on {task.data['id']}, it expired or was cancelled")
+        if cancellation.cancelled:
+            print(f"Stopped converting task {task.data['id']}: {cancellation.reason}")
+            return
+        _write(os.path.join(self.done_dir, task.name), result)
+        try:
+            os.remove(claimed)
+        except FileNotFoundError:
+            pass
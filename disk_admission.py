@@ -0,0 +1,157 @@
+"""Admission control for the staging disk under base_path.
+
+A conversion writes its output next to the source, and both stay on the
+staging disk until rclone moves the result away, so a dozen parallel
+transcodes and UHD remuxes can fill the disk and make every convert and
+upload fail at once. The pipeline asks DiskAdmission before it starts a
+conversion: the conversion reserves its estimated output size and only
+starts if that fits in the free space, less the headroom and what running
+conversions have reserved but not written yet. What a running conversion has
+written already shows in the free space, so it is measured from the files
+next to its source that share the source's name (the .m4v, a remux's
+temporary file) and were modified since it started, and only the rest of its
+reservation is held back. The reservation is released when the conversion
+ends.
+
+While a conversion is held back the disk is tight: pending upload batches
+are sent right away instead of waiting out their batching window, because
+an upload is what frees space. The free space is checked again every
+`poll_interval` seconds and the listeners (the pipeline) are told to retry.
+"""
+
+import os, threading, time
+
+
+class DiskAdmission:
+    """Reserves disk space for conversions before they start.
+
+    Arguments:
+        path (str): A directory on the staging disk, normally base_path.
+        headroom (int): Bytes to always leave free.
+        output_ratio (float): Expected output size as a fraction of the source size.
+        max_wait (float): Seconds a conversion that does not fit waits while nothing else is
+            converting before it starts anyway, so a file larger than the disk fails instead of
+            blocking the queue forever.
+        on_tight (callable): Called while a conversion is held back, for example to flush uploads.
+        poll_interval (float): Seconds between checks of the free space while a conversion waits.
+    """
+
+    def __init__(self, path, headroom=0, output_ratio=1.0, max_wait=600, on_tight=None, poll_interval=2):
+        self.path = path
+        self.headroom = headroom
+        self.output_ratio = output_ratio
+        self.max_wait = max_wait
+        self.on_tight = on_tight
+        self.poll_interval = poll_interval
+        self._reserved = {}
+        self._blocked_since = None
+        self._attempts = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="disk-admission", daemon=True)
+
+    def subscribe(self, listener):
+        """Call listener() whenever space may have become available."""
+        self._listeners.append(listener)
+
+    def start(self):
+        self._thread.start()
+
+    def free(self):
+        stat = os.statvfs(self.path)
+        return stat.f_bavail * stat.f_frsize
+
+    def estimate(self, source_path):
+        """Return the bytes a conversion of source_path is expected to write."""
+        try:
+            return int(os.path.getsize(source_path) * self.output_ratio)
+        except OSError:
+            return 0
+
+    def reserve(self, key, size, source_path=None):
+        """Reserve size bytes for key if they fit. Returns whether the conversion may start.
+
+        Arguments:
+            key: Identifies the conversion, for release().
+            size (int): The bytes it is expected to write, see estimate().
+            source_path (str): The file it converts, so what it has written so far is not counted twice.
+        """
+        with self._lock:
+            if key in self._reserved:
+                return True
+            self._attempts += 1
+            available = self.free() - self.headroom - self._unwritten()
+            now = time.monotonic()
+            waited = now - self._blocked_since if self._blocked_since is not None else 0
+            if size > available and (self._reserved or waited < self.max_wait):
+                if self._blocked_since is None:
+                    print(f"Staging disk is tight: {available / 1e9:.1f} GB available, the next conversion needs "
+                          f"{size / 1e9:.1f} GB, holding conversions back and flushing uploads")
+                    self._blocked_since = now
+                    self._wake.set()
+                return False
+            if size > available:
+                print(f"Starting a conversion needing {size / 1e9:.1f} GB with only {available / 1e9:.1f} GB "
+                      f"available after waiting {waited:.0f}s")
+            self._reserved[key] = (size, source_path, time.time())
+            self._blocked_since = None
+            return True
+
+    def _unwritten(self):
+        # Called with the lock held
+        return sum(max(0, size - self._written(source_path, started)) for size, source_path, started in self._reserved.values())
+
+    @staticmethod
+    def _written(source_path, since):
+        """Return the bytes in the files next to source_path named after it and modified since `since`."""
+        if not source_path:
+            return 0
+        directory, name = os.path.split(source_path)
+        prefix = os.path.splitext(name)[0] + "."
+        written = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith(prefix) and entry.name != name:
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        if stat.st_mtime >= since:
+                            written += stat.st_size
+        except OSError:
+            return 0
+        return written
+
+    def release(self, key):
+        """Drop the reservation of key, once its conversion has finished or failed."""
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._blocked_since is None:
+                continue
+            if self.on_tight:
+                self.on_tight()
+            attempts = self._attempts
+            for listener in self._listeners:
+                listener()
+            with self._lock:
+                if self._attempts == attempts:
+                    # Nothing is waiting for space any more, for example the waiting job was cancelled
+                    self._blocked_since = None
+
+    def gauges(self):
+        """Return (name, labels, value) tuples for JobMetrics."""
+        with self._lock:
+            reserved = self._unwritten()
+            blocked = int(self._blocked_since is not None)
+        try:
+            free = self.free()
+        except OSError:
+            return [("staging_reserved_bytes", {}, reserved), ("staging_blocked", {}, blocked)]
+        return [("staging_free_bytes", {}, free), ("staging_reserved_bytes", {}, reserved), ("staging_blocked", {}, blocked)]
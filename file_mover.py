@@ -0,0 +1,185 @@
+"""Moves media files, renaming on the same filesystem and copying safely across them.
+
+A rename is atomic and instant, so it is always tried first. When source and
+destination are on different filesystems the file is copied to a hidden
+temporary name next to the destination with copy_file_range (falling back to
+sendfile, then to a large-buffer copy), checked against the source, fsynced
+and renamed into place before the source is removed. A failed or interrupted
+copy never leaves a partial file under the final name. Copies onto the same
+disk are throttled so several multi-GB copies do not fight over one spindle.
+"""
+
+import errno, hashlib, os, threading, time
+
+CHUNK = 64 * 1024 * 1024
+BUFFER = 8 * 1024 * 1024
+VERIFY = ("size", "checksum")
+
+
+class FileMover:
+    """Moves files with a rename fast path and a verified cross-device copy.
+
+    Arguments:
+        copies_per_disk (int): Concurrent cross-device copies allowed onto one destination filesystem.
+        verify (str): "size" to compare sizes after a copy, or "checksum" to also compare BLAKE2 digests.
+        progress_interval (float): Seconds between progress reports of a copy.
+    """
+
+    def __init__(self, copies_per_disk=1, verify="size", progress_interval=10):
+        if verify not in VERIFY:
+            raise ValueError(f"verify must be one of {VERIFY}, not {verify}")
+        self.copies_per_disk = copies_per_disk
+        self.verify = verify
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self._disks = {}
+
+    def _disk(self, directory):
+        device = os.stat(directory).st_dev
+        with self._lock:
+            if device not in self._disks:
+                self._disks[device] = threading.BoundedSemaphore(self.copies_per_disk)
+            return self._disks[device]
+
+    def move(self, source, destination):
+        """Move source to destination, creating the destination directory.
+
+        Returns:
+            str: "rename" or "copy", depending on how the file was moved.
+        """
+        directory = os.path.dirname(destination) or "."
+        os.makedirs(directory, exist_ok=True)
+        if os.stat(source).st_dev == os.stat(directory).st_dev:
+            try:
+                os.rename(source, destination)
+                return "rename"
+            except OSError as e:
+                # Bind mounts and some union filesystems share a device id but refuse renames
+                if e.errno != errno.EXDEV:
+                    raise
+        with self._disk(directory):
+            self._copy_and_replace(source, destination)
+        return "copy"
+
+    def _copy_and_replace(self, source, destination):
+        directory, name = os.path.split(destination)
+        tmp = os.path.join(directory, f".{name}.partial")
+        try:
+            digest = self._copy(source, tmp)
+            self._check(source, tmp, digest)
+            os.rename(tmp, destination)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        _fsync_directory(directory)
+        os.unlink(source)
+
+    def _copy(self, source, tmp):
+        size = os.path.getsize(source)
+        progress = _Progress(source, size, self.progress_interval)
+        digest = hashlib.blake2b() if self.verify == "checksum" else None
+        with open(source, "rb") as src, open(tmp, "wb") as dst:
+            if digest is None:
+                copied = _copy_zero(src.fileno(), dst.fileno(), size, progress)
+            else:
+                copied = 0
+            if copied < size:
+                # The checksum needs the data in user space, and not every kernel and
+                # filesystem supports the zero-copy calls
+                src.seek(copied)
+                dst.seek(copied)
+                _copy_buffered(src, dst, digest, progress)
+            dst.flush()
+            os.fsync(dst.fileno())
+        progress.done()
+        return digest
+
+    def _check(self, source, tmp, digest):
+        expected, actual = os.path.getsize(source), os.path.getsize(tmp)
+        if expected != actual:
+            raise IOError(f"Copy of {source} is {actual} bytes, expected {expected}")
+        if digest is not None and _file_digest(tmp) != digest.digest():
+            raise IOError(f"Copy of {source} does not match the original")
+
+
+class _Progress:
+    def __init__(self, path, size, interval):
+        self.path = path
+        self.size = size
+        self.interval = interval
+        self.copied = 0
+        self.started = self.reported = time.monotonic()
+
+    def add(self, count):
+        self.copied += count
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            print(f"Copying {self.path}: {self.copied * 100 // max(self.size, 1)}% "
+                  f"({self.copied / 1e9:.1f} of {self.size / 1e9:.1f} GB, {self.rate(now) / 1e6:.0f} MB/s)")
+
+    def rate(self, now):
+        return self.copied / max(now - self.started, 1e-9)
+
+    def done(self):
+        now = time.monotonic()
+        print(f"Copied {self.path}: {self.copied / 1e9:.1f} GB in {now - self.started:.1f}s ({self.rate(now) / 1e6:.0f} MB/s)")
+
+
+def _copy_zero(src_fd, dst_fd, size, progress):
+    """Copy with copy_file_range, or sendfile where that is unsupported. Returns the bytes copied."""
+    copied = 0
+    for call in (getattr(os, "copy_file_range", None), os.sendfile):
+        if call is None:
+            continue
+        try:
+            while copied < size:
+                if call is os.sendfile:
+                    # sendfile writes at the destination's file position, copy_file_range does not move it
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    count = os.sendfile(dst_fd, src_fd, copied, min(CHUNK, size - copied))
+                else:
+                    count = call(src_fd, dst_fd, min(CHUNK, size - copied), copied, copied)
+                if count == 0:
+                    break
+                copied += count
+                progress.add(count)
+            return copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    return copied
+
+
+def _copy_buffered(src, dst, digest, progress):
+    buffer = bytearray(BUFFER)
+    view = memoryview(buffer)
+    while True:
+        count = src.readinto(buffer)
+        if not count:
+            return
+        dst.write(view[:count])
+        if digest is not None:
+            digest.update(view[:count])
+        progress.add(count)
+
+
+def _file_digest(path):
+    digest = hashlib.blake2b()
+    buffer = bytearray(BUFFER)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                return digest.digest()
+            digest.update(view[:count])
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,84 @@
+"""An asyncio event loop for the network-bound job steps.
+
+The Plex, Radarr, TMDb and OMDb clients are blocking libraries, so a job
+waiting on one of them used to hold an API pool thread for the whole call,
+and a slow Radarr could occupy every thread while TMDb lookups queued behind
+it. Steps written as coroutines run on a single loop thread instead. Each
+service has its own concurrency limit and its own small executor for the
+blocking client calls, so a job only holds a thread while its request is
+actually in flight, jobs queued for a busy service cost nothing but a
+coroutine, and one slow service cannot starve the others.
+"""
+
+import asyncio, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncRunner:
+    """Runs coroutines on a background event loop with per-service limits.
+
+    Arguments:
+        limits (dict): Mapping of service name to the most calls in flight at once.
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.loop = asyncio.new_event_loop()
+        self._executors = {
+            name: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"{name}-io")
+            for name, limit in self.limits.items()
+        }
+        self._semaphores = {}
+        self._waiting = {name: 0 for name in self.limits}
+        self._in_flight = {name: 0 for name in self.limits}
+        self._thread = threading.Thread(target=self._run, name="async-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _semaphore(self, service):
+        # Created lazily so they belong to the running loop
+        if service not in self._semaphores:
+            self._semaphores[service] = asyncio.Semaphore(self.limits[service])
+        return self._semaphores[service]
+
+    def submit(self, coro):
+        """Schedule a coroutine from any thread. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def call(self, service, fn, *args):
+        """Run a blocking client call on the service's executor, within its concurrency limit."""
+        self._waiting[service] += 1
+        async with self._semaphore(service):
+            self._waiting[service] -= 1
+            self._in_flight[service] += 1
+            try:
+                return await self.loop.run_in_executor(self._executors[service], fn, *args)
+            finally:
+                self._in_flight[service] -= 1
+
+    async def wait_event(self, event, timeout=None, poll=0.5):
+        """Wait for a threading.Event without holding a thread. Returns whether it was set."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not event.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(poll)
+        return True
+
+    def gauges(self):
+        """Return (name, labels, value) tuples for every service, for JobMetrics."""
+        samples = []
+        for name, limit in self.limits.items():
+            samples.append(("service_limit", {"service": name}, limit))
+            samples.append(("service_in_flight", {"service": name}, self._in_flight[name]))
+            samples.append(("service_waiting", {"service": name}, self._waiting[name]))
+        return samples
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        for executor in self._executors.values():
+            executor.shutdown()
@@ -0,0 +1,110 @@
+"""Cancelling jobs that are already running.
+
+Every job carries a Cancellation. Cancelling it marks the job, calls back
+whatever a step in flight registered (taking a file out of an upload batch,
+a task out of the convert queue) and terminates the subprocesses started
+through its `run`, so a superseded transcode or upload stops right away
+instead of running to completion. The pipeline checks the mark between
+steps, and a step interrupted by it raises JobCancelled.
+"""
+
+import os, signal, subprocess, threading, time
+
+
+class JobCancelled(Exception):
+    """Raised by a step whose job was cancelled."""
+
+
+class Cancellation:
+    """The cancellation state of one job, or of one upload batch.
+
+    Arguments:
+        grace (float): Seconds a terminated subprocess gets to exit before it is killed.
+    """
+
+    def __init__(self, grace=10):
+        self.grace = grace
+        self.reason = None
+        # When it was cancelled, by time.time()
+        self.cancelled_at = None
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def check(self):
+        """Raise JobCancelled if the job was cancelled."""
+        if self.reason is not None:
+            raise JobCancelled(self.reason)
+
+    def on_cancel(self, callback):
+        """Call callback() when the job is cancelled, or now if it already was."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason):
+        """Cancel the job. Returns False if it was already cancelled."""
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            self.cancelled_at = time.time()
+            callbacks, self._callbacks = self._callbacks, []
+            processes = list(self._processes)
+        for process in processes:
+            self._terminate(process)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error while cancelling: {e}")
+        return True
+
+    def _terminate(self, process):
+        # Each process leads its own session, so a shell and everything it started go together
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        timer = threading.Timer(self.grace, self._kill, (process,))
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _kill(process):
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run(self, command, check=False, capture_output=False, **kwargs):
+        """A subprocess.run that terminates the process if the job is cancelled.
+
+        Raises:
+            JobCancelled: If the job was cancelled before or while the process ran.
+        """
+        self.check()
+        if capture_output:
+            kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+        process = subprocess.Popen(command, start_new_session=True, **kwargs)
+        with self._lock:
+            self._processes.add(process)
+            cancelled = self.reason is not None
+        if cancelled:
+            self._terminate(process)
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        self.check()
+        if check and process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
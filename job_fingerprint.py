@@ -0,0 +1,54 @@
+"""Identify what a job converts, to spot re-fired and superseded webhook events.
+
+Sonarr and Radarr fire again for retries and for upgrades. A job's media key
+names the episode or movie it is about, and its fingerprint names the exact
+file: its size and a BLAKE2 hash of a few samples of its content, so a
+multi-GB file is identified by reading a few MB. A new event with the same
+key and fingerprint as a job that is running or done is a duplicate. One
+with the same key and a different fingerprint is an upgrade that supersedes
+the running job.
+"""
+
+import hashlib, os
+
+SAMPLE = 1024 * 1024
+SAMPLES = 3
+
+
+def media_key(kind, payload):
+    """Return the episode or movie a webhook payload is about, or None if it does not say."""
+    try:
+        if kind == "sonarr":
+            return f"tv:{payload['seriestitle']}:{int(payload['season_number'])}:{int(payload['ep_number'])}"
+        return f"{kind}:{int(payload['tmdbid'])}"
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def media_path(kind, payload):
+    """Return the path of the job's file relative to base_path."""
+    path = payload.get("epidodepath") if kind == "sonarr" else payload.get("moviepath")
+    return (path or "").lstrip("/")
+
+
+def fingerprint(file_path):
+    """Return "<size>:<hash>" for a file, hashing SAMPLES evenly spaced SAMPLE-byte blocks, or None if it is missing."""
+    try:
+        size = os.path.getsize(file_path)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            if size <= SAMPLE * SAMPLES:
+                digest.update(f.read())
+            else:
+                for n in range(SAMPLES):
+                    f.seek((size - SAMPLE) * n // (SAMPLES - 1))
+                    digest.update(f.read(SAMPLE))
+    except OSError:
+        return None
+    return f"{size}:{digest.hexdigest()}"
+
+
+def identify(kind, payload, base_path):
+    """Return the media key and fingerprint of a webhook payload; either may be None."""
+    relative = media_path(kind, payload)
+    return media_key(kind, payload), fingerprint(os.path.join(base_path, relative)) if relative else None
@@ -0,0 +1,205 @@
+"""Crash-safe journal of TV and movie jobs.
+
+Every job is recorded in a small SQLite database together with the last
+stage it completed and whatever state later stages need (converted path,
+sorted path, ...). When the daemon restarts, `JobJournal.pending` returns
+the unfinished jobs so they resume after their last completed stage instead
+of being lost or transcoded again.
+
+Jobs also record the media key and fingerprint of their file (see
+job_fingerprint.py), which makes the journal the index that finds
+re-fired duplicates and the running jobs an upgrade supersedes.
+"""
+
+import json, os, sqlite3, threading, time
+from job_cancel import Cancellation
+
+TV_STAGES = ("converted", "uploaded", "plex_refreshed")
+MOVIE_STAGES = ("radarr_removed", "converted", "sorted", "uploaded", "plex_refreshed")
+
+STAGES = {
+    "sonarr": TV_STAGES,
+    "radarr": MOVIE_STAGES,
+    "uhd_radarr": MOVIE_STAGES,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_key TEXT UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    stage TEXT,
+    state TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'running',
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+# Columns added after the first release, created on journals that predate them
+_COLUMNS = {
+    "media_key": "TEXT",
+    "fingerprint": "TEXT",
+}
+
+
+class JournalEntry:
+    """A job as recorded in the journal.
+
+    Attributes:
+        id (int): The journal id of the job.
+        kind (str): The spool kind the job came from (sonarr, radarr, uhd_radarr).
+        payload (dict): The webhook payload.
+        stage (str): The last completed stage, or None if nothing has run yet.
+        state (dict): Values produced by completed stages.
+        cancellation (Cancellation): Cancelled when a newer job supersedes this one.
+    """
+
+    def __init__(self, id, kind, payload, stage, state):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.stage = stage
+        self.state = state
+        self.cancellation = Cancellation()
+
+    def reached(self, stage):
+        """Return True if `stage` has already been completed for this job."""
+        if self.stage is None:
+            return False
+        stages = STAGES[self.kind]
+        return stages.index(self.stage) >= stages.index(stage)
+
+
+class JobJournal:
+    """SQLite-backed job journal shared by all worker threads.
+
+    Arguments:
+        db_path (str): Where to keep the journal database.
+    """
+
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, kind in _COLUMNS.items():
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_media_key ON jobs (media_key)")
+
+    def add(self, kind, payload, event_key=None, media_key=None, fingerprint=None):
+        """Record a new job.
+
+        Arguments:
+            kind (str): The spool kind of the job.
+            payload (dict): The webhook payload.
+            event_key (str): A unique key for the originating event, so an
+                event that is delivered twice is only journaled once.
+            media_key (str): The episode or movie the job is about, see job_fingerprint.
+            fingerprint (str): The fingerprint of the job's file, see job_fingerprint.
+
+        Returns:
+            tuple: The `JournalEntry` and True if it was newly created.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (event_key, kind, payload, media_key, fingerprint, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (event_key, kind, json.dumps(payload), media_key, fingerprint, now, now),
+            )
+            if cursor.rowcount:
+                return JournalEntry(cursor.lastrowid, kind, payload, None, {}), True
+            row = self._db.execute(
+                "SELECT id, kind, payload, stage, state FROM jobs WHERE event_key = ?", (event_key,)
+            ).fetchone()
+        return self._entry(row), False
+
+    def advance(self, entry, stage):
+        """Record that `stage` completed, persisting the entry's current state."""
+        if stage not in STAGES[entry.kind]:
+            raise ValueError(f"Unknown stage {stage} for {entry.kind} jobs")
+        entry.stage = stage
+        status = "done" if stage == STAGES[entry.kind][-1] else "running"
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET stage = ?, state = ?, status = ?, updated = ? WHERE id = ?",
+                (stage, json.dumps(entry.state), status, time.time(), entry.id),
+            )
+
+    def finish(self, entry):
+        """Mark a job done even if it skipped its remaining stages."""
+        self._set_status(entry, "done")
+
+    def fail(self, entry, error):
+        """Mark a job failed. Failed jobs are kept for inspection but not resumed."""
+        self._set_status(entry, "failed", str(error))
+
+    def cancel(self, entry, reason):
+        """Mark a job cancelled, for example because a newer file superseded it. It is not resumed."""
+        self._set_status(entry, "cancelled", reason)
+
+    def duplicate_of(self, media_key, fingerprint):
+        """Return the id of a running or done job for the same file, or None.
+
+        Without a fingerprint, because the file is already gone (converted or replaced by the
+        mover), any running or done job for the same episode or movie counts as the same file.
+        """
+        if media_key is None:
+            return None
+        with self._lock:
+            if fingerprint is None:
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE media_key = ? AND status IN ('running', 'done') "
+                    "ORDER BY id DESC LIMIT 1", (media_key,)
+                ).fetchone()
+            else:
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE media_key = ? AND fingerprint = ? AND status IN ('running', 'done') "
+                    "ORDER BY id DESC LIMIT 1", (media_key, fingerprint)
+                ).fetchone()
+        return row[0] if row else None
+
+    def superseded_by(self, entry):
+        """Return the ids of the older running jobs for the same episode or movie as entry.
+
+        A job without a fingerprint supersedes nothing, since it cannot tell its file is a new one.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT media_key, fingerprint FROM jobs WHERE id = ?", (entry.id,)).fetchone()
+            if row is None or row[0] is None or row[1] is None:
+                return []
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE media_key = ? AND status = 'running' AND id < ? ORDER BY id",
+                (row[0], entry.id)
+            ).fetchall()
+        return [id for id, in rows]
+
+    def _set_status(self, entry, status, error=None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, state = ?, updated = ? WHERE id = ?",
+                (status, error, json.dumps(entry.state), time.time(), entry.id),
+            )
+
+    def pending(self):
+        """Return every job that has not finished or failed, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, kind, payload, stage, state FROM jobs WHERE status = 'running' ORDER BY id"
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    @staticmethod
+    def _entry(row):
+        id, kind, payload, stage, state = row
+        return JournalEntry(id, kind, json.loads(payload), stage, json.loads(state))
@@ -0,0 +1,137 @@
+"""Per-job stage timings and a Prometheus-style metrics endpoint.
+
+Every timed stage is appended to a JSON-lines event log and folded into a
+latency histogram. Counters and gauges (queue depths, pool utilisation) are
+exposed together with the histograms in the Prometheus text format on a
+local HTTP port.
+"""
+
+import json, os, threading, time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, float("inf"))
+
+_PREFIX = "media_processor"
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class JobMetrics:
+    """Collects stage timings, counters and gauges.
+
+    Arguments:
+        log_path (str): The JSON-lines file stage events are appended to, or
+            None to keep metrics in memory only.
+    """
+
+    def __init__(self, log_path=None):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = []
+        self._log = None
+        if log_path:
+            directory = os.path.dirname(log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._log = open(log_path, "a", buffering=1)
+
+    def record(self, job, stage, seconds, **extra):
+        """Record one timed stage.
+
+        Arguments:
+            job (JournalEntry): The job the stage belongs to, or None for shared work.
+            stage (str): The stage name, used as the histogram label.
+            seconds (float): How long the stage took.
+            **extra: Additional fields for the event log, such as bytes uploaded.
+        """
+        event = {"time": time.time(), "job": job.id if job else None, "kind": job.kind if job else None,
+                 "stage": stage, "seconds": round(seconds, 3)}
+        event.update(extra)
+        with self._lock:
+            self._histograms.setdefault(stage, _Histogram()).observe(seconds)
+            if self._log:
+                self._log.write(json.dumps(event) + "\n")
+
+    @contextmanager
+    def timed(self, job, stage, **extra):
+        """Time the body of a with block as `stage`, marking it failed if it raises."""
+        started = time.monotonic()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.record(job, stage, time.monotonic() - started, ok=ok, **extra)
+
+    def increment(self, name, value=1, **labels):
+        """Add to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauges(self, source):
+        """Register a callable returning (name, labels, value) tuples, sampled on every scrape."""
+        self._gauges.append(source)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = [f"# TYPE {_PREFIX}_stage_seconds histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'{_PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+                lines.append(f'{_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{_PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = sorted(self._counters.items())
+        for (name, labels), value in counters:
+            lines.append(f"{_PREFIX}_{name}{_labels(dict(labels))} {value}")
+        for source in self._gauges:
+            for name, labels, value in source():
+                lines.append(f"{_PREFIX}_{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve /metrics on a local port from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
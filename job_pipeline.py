@@ -0,0 +1,371 @@
+"""Stage-specific worker pools for TV and movie jobs.
+
+A job is a list of steps. Each step names the journal stage it completes and
+the pool it runs on, so CPU-bound conversion, bandwidth-bound uploads and
+lightweight API calls are sized independently. When a step finishes, the
+job is queued on the pool of its next step, so a slow upload never holds a
+conversion slot and a transcode never holds an upload slot. Steps written
+as coroutines run on an AsyncRunner's event loop instead of a pool thread.
+
+Steps waiting for a pool are not run first come, first served: a
+PriorityScheduler picks which one a free worker takes next, so TV episodes
+are not stuck behind a flood of hour-long UHD transcodes.
+
+A running job can be cancelled through its journal entry's Cancellation
+(see job_cancel.py); it stops at its next step and is journaled cancelled.
+"""
+
+import asyncio, threading, time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from job_cancel import JobCancelled
+
+_Waiting = namedtuple("_Waiting", ["job_class", "queued_at", "job", "steps", "index"])
+
+
+class Step:
+    """One unit of work in a job.
+
+    Arguments:
+        stage (str): The journal stage recorded when the step completes, or
+            None for steps that are not journaled.
+        pool (str): The name of the pool that runs the step. Ignored for
+            coroutine steps, which are reported under the "async" pool.
+        fn (callable): Called with the job. Returning False ends the job early.
+            Returning a Future releases the worker, and the step completes
+            with the future's result. A coroutine function is awaited on the
+            pipeline's AsyncRunner.
+        reserve (callable): Optional. Called with the job, returns the bytes of staging
+            disk the step writes and the source file it writes them next to, or None.
+            The step waits until the pipeline's DiskAdmission can reserve them, and
+            holds the reservation until it completes.
+    """
+
+    def __init__(self, stage, pool, fn, reserve=None):
+        self.stage = stage
+        self.fn = fn
+        self.pool = "async" if asyncio.iscoroutinefunction(fn) else pool
+        self.reserve = reserve
+
+
+class PriorityScheduler:
+    """Decides which waiting step a pool runs next.
+
+    Every job belongs to a class, by default its kind. A free worker takes the
+    waiting step with the highest effective priority: its class's priority plus
+    one for every `aging` seconds it has waited, so high-priority work goes
+    first but a steady stream of it cannot starve the rest. Steps of equal
+    priority run in the order they were queued. A class can also be capped to a
+    number of a pool's workers, for example at most two UHD transcodes at once.
+
+    Arguments:
+        classes (dict): Mapping of job kind to class name. Kinds not listed are their own class.
+        priorities (dict): Mapping of class name to priority, higher first. Classes not listed get 0.
+        limits (dict): Mapping of class name to {pool name: most workers of the pool the class may use}.
+        aging (float): Seconds of waiting that raise a step's priority by one. 0 turns aging off.
+    """
+
+    def __init__(self, classes=None, priorities=None, limits=None, aging=0):
+        self.classes = dict(classes or {})
+        self.configure(priorities, limits, aging)
+
+    def configure(self, priorities=None, limits=None, aging=0):
+        """Replace the priorities, limits and aging. Takes effect on the next pick."""
+        self.priorities = dict(priorities or {})
+        self.limits = {name: dict(pools) for name, pools in (limits or {}).items()}
+        self.aging = aging
+
+    def job_class(self, job):
+        return self.classes.get(job.kind, job.kind)
+
+    def priority(self, waiting, now):
+        priority = self.priorities.get(waiting.job_class, 0)
+        if self.aging:
+            priority += (now - waiting.queued_at) / self.aging
+        return priority
+
+    def pick(self, pool, waiting, running, now):
+        """Return the entry of waiting to run next, or None if every class waiting is at its limit.
+
+        Arguments:
+            pool (str): The pool with a free worker.
+            waiting (list): Entries with a job_class and queued_at, oldest first.
+            running (dict): Mapping of (pool, class) to the number of the pool's workers the class is using.
+            now (float): The current time, on the clock queued_at was taken from.
+        """
+        best, best_priority = None, None
+        for entry in waiting:
+            limit = self.limits.get(entry.job_class, {}).get(pool)
+            if limit is not None and running.get((pool, entry.job_class), 0) >= limit:
+                continue
+            priority = self.priority(entry, now)
+            if best is None or priority > best_priority:
+                best, best_priority = entry, priority
+        return best
+
+
+class Pipeline:
+    """Runs job steps on named worker pools.
+
+    Arguments:
+        pool_sizes (dict): Mapping of pool name to its number of workers.
+        journal (JobJournal): Records completed stages, early finishes and failures.
+        metrics (JobMetrics): Optional sink for per-step queue wait and run times.
+        runner (AsyncRunner): Runs the coroutine steps. Required if any step is a coroutine.
+        scheduler (PriorityScheduler): Orders the steps waiting for a pool. Defaults to first come, first served.
+        admission (DiskAdmission): Holds back steps with a `reserve` until their disk space fits.
+        on_cancelled (callable): Optional. Called with a job once it is journaled cancelled, for
+            example to remove the files it left behind.
+    """
+
+    def __init__(self, pool_sizes, journal, metrics=None, runner=None, scheduler=None, admission=None, on_cancelled=None):
+        self.journal = journal
+        self.metrics = metrics
+        self.runner = runner
+        self.scheduler = scheduler or PriorityScheduler()
+        self.admission = admission
+        self.on_cancelled = on_cancelled
+        self._sizes = dict(pool_sizes)
+        self._pools = {
+            name: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{name}-pool")
+            for name, size in pool_sizes.items()
+        }
+        self._queued = {name: 0 for name in list(pool_sizes) + ["async"]}
+        self._busy = {name: 0 for name in list(pool_sizes) + ["async"]}
+        # Steps waiting for a worker, and the workers handed out per pool and per (pool, class)
+        self._waiting = {name: [] for name in pool_sizes}
+        self._running = {name: 0 for name in pool_sizes}
+        self._class_running = {}
+        self._jobs = {}
+        self._active = 0
+        self._idle = threading.Condition()
+
+    def resize(self, pool_sizes):
+        """Change the number of workers of the given pools without waiting for running steps.
+
+        Steps already running or queued on a resized pool finish there, new steps
+        go to a pool of the new size.
+        """
+        for name, size in pool_sizes.items():
+            if self._sizes.get(name) == size:
+                continue
+            with self._idle:
+                old = self._pools.get(name)
+                self._pools[name] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{name}-pool")
+                self._sizes[name] = size
+                self._queued.setdefault(name, 0)
+                self._busy.setdefault(name, 0)
+                self._waiting.setdefault(name, [])
+                self._running.setdefault(name, 0)
+                self._dispatch(name)
+            if old is not None:
+                old.shutdown(wait=False)
+
+    def reschedule(self):
+        """Hand free workers to waiting steps, after the scheduler's priorities or limits changed."""
+        with self._idle:
+            for name in self._waiting:
+                self._dispatch(name)
+
+    def submit(self, job, steps):
+        """Start a job, skipping the steps its journal entry already completed."""
+        with self._idle:
+            self._active += 1
+            self._jobs[job.id] = job
+        self._next(job, steps, 0)
+
+    def cancel(self, job_id, reason):
+        """Cancel a running job: its subprocesses are stopped and it ends at its next step.
+
+        Returns:
+            bool: False if the job is not running in this pipeline.
+        """
+        with self._idle:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancellation.cancel(reason)
+        return True
+
+    def _next(self, job, steps, index):
+        while index < len(steps) and steps[index].stage and job.reached(steps[index].stage):
+            index += 1
+        if index == len(steps):
+            self._done(job)
+            return
+        if job.cancellation.cancelled:
+            self._failed(job, JobCancelled(job.cancellation.reason))
+            return
+        pool = steps[index].pool
+        if pool == "async":
+            with self._idle:
+                self._queued[pool] += 1
+            self.runner.submit(self._run_async(job, steps, index, time.monotonic()))
+            return
+        with self._idle:
+            self._queued[pool] += 1
+            self._waiting[pool].append(_Waiting(self.scheduler.job_class(job), time.monotonic(), job, steps, index))
+            self._dispatch(pool)
+
+    def _dispatch(self, pool):
+        """Start waiting steps of a pool while it has free workers. Called with the lock held,
+        so a concurrent resize() cannot shut the pool down in between."""
+        waiting = self._waiting[pool]
+        while waiting and self._running[pool] < self._sizes[pool]:
+            entry = self.scheduler.pick(pool, waiting, self._class_running, time.monotonic())
+            if entry is None:
+                return
+            step = entry.steps[entry.index]
+            if self.admission and step.reserve and not self.admission.reserve(entry.job.id, *step.reserve(entry.job)):
+                # Nothing else starts on this pool until the next step in line fits, so freed space goes to it
+                return
+            waiting.remove(entry)
+            self._running[pool] += 1
+            key = (pool, entry.job_class)
+            self._class_running[key] = self._class_running.get(key, 0) + 1
+            self._pools[pool].submit(self._run, entry.job, entry.steps, entry.index, entry.queued_at)
+
+    def _start(self, job, step, queued_at):
+        started = time.monotonic()
+        with self._idle:
+            self._queued[step.pool] -= 1
+            self._busy[step.pool] += 1
+        if self.metrics:
+            self.metrics.record(job, f"{step.pool}_wait", started - queued_at)
+        return started
+
+    async def _run_async(self, job, steps, index, queued_at):
+        step = steps[index]
+        started = self._start(job, step, queued_at)
+        try:
+            job.cancellation.check()
+            result = await step.fn(job)
+        except Exception as e:
+            self._finished_step(job, step, started, False)
+            self._failed(job, e)
+            return
+        self._finished_step(job, step, started, True, result)
+        self._complete(job, steps, index, result)
+
+    def _run(self, job, steps, index, queued_at):
+        step = steps[index]
+        started = self._start(job, step, queued_at)
+        try:
+            job.cancellation.check()
+            result = step.fn(job)
+        except Exception as e:
+            self._finished_step(job, step, started, False)
+            self._failed(job, e)
+            return
+        if isinstance(result, Future):
+            # The step handed its work to another queue, free this worker until it completes.
+            self._release(job, step)
+            result.add_done_callback(lambda future: self._resolved(job, steps, index, started, future))
+            return
+        self._finished_step(job, step, started, True, result)
+        self._complete(job, steps, index, result)
+
+    def _resolved(self, job, steps, index, started, future):
+        self._unreserve(job, steps[index])
+        try:
+            result = future.result()
+        except Exception as e:
+            self._record(job, steps[index], started, False)
+            self._failed(job, e)
+            return
+        self._record(job, steps[index], started, True, result)
+        self._complete(job, steps, index, result)
+
+    def _release(self, job, step):
+        with self._idle:
+            self._busy[step.pool] -= 1
+            if step.pool in self._running:
+                self._running[step.pool] -= 1
+                self._class_running[(step.pool, self.scheduler.job_class(job))] -= 1
+                self._dispatch(step.pool)
+
+    def _unreserve(self, job, step):
+        if self.admission and step.reserve:
+            self.admission.release(job.id)
+            self.reschedule()
+
+    def _finished_step(self, job, step, started, ok, result=None):
+        self._release(job, step)
+        self._unreserve(job, step)
+        self._record(job, step, started, ok, result)
+
+    def _record(self, job, step, started, ok, result=None):
+        if self.metrics:
+            extra = result if isinstance(result, dict) else {}
+            self.metrics.record(job, step.stage or step.fn.__name__, time.monotonic() - started, ok=ok, **extra)
+
+    def _complete(self, job, steps, index, result):
+        step = steps[index]
+        if job.cancellation.cancelled:
+            self._failed(job, JobCancelled(job.cancellation.reason))
+            return
+        try:
+            if result is False:
+                self.journal.finish(job)
+                self._done(job)
+                return
+            if step.stage:
+                self.journal.advance(job, step.stage)
+        except Exception as e:
+            self._failed(job, e)
+            return
+        self._next(job, steps, index + 1)
+
+    def _failed(self, job, error):
+        if job.cancellation.cancelled:
+            print(f"Job {job.id} cancelled after stage {job.stage}: {job.cancellation.reason}")
+            self.journal.cancel(job, job.cancellation.reason)
+            if self.on_cancelled:
+                try:
+                    self.on_cancelled(job)
+                except Exception as e:
+                    print(f"Cleaning up after cancelled job {job.id} failed: {e}")
+        else:
+            print(f"Job {job.id} failed after stage {job.stage}: {error}")
+            self.journal.fail(job, error)
+        self._done(job)
+
+    def _done(self, job):
+        with self._idle:
+            self._active -= 1
+            self._jobs.pop(job.id, None)
+            self._idle.notify_all()
+
+    def gauges(self):
+        """Return (name, labels, value) tuples describing the pools, for JobMetrics."""
+        with self._idle:
+            samples = [("jobs_active", {}, self._active)]
+            for name in self._queued:
+                if name in self._sizes:
+                    samples.append(("pool_workers", {"pool": name}, self._sizes[name]))
+                samples.append(("pool_busy", {"pool": name}, self._busy[name]))
+                samples.append(("pool_queued", {"pool": name}, self._queued[name]))
+            for (pool, job_class), running in self._class_running.items():
+                samples.append(("pool_busy_by_class", {"pool": pool, "class": job_class}, running))
+            for name, waiting in self._waiting.items():
+                counts = {}
+                for entry in waiting:
+                    counts[entry.job_class] = counts.get(entry.job_class, 0) + 1
+                for job_class, count in counts.items():
+                    samples.append(("pool_queued_by_class", {"pool": name, "class": job_class}, count))
+        return samples
+
+    def active(self):
+        """Return the number of jobs that have not finished yet."""
+        with self._idle:
+            return self._active
+
+    def join(self):
+        """Block until every submitted job has finished."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._active == 0)
+
+    def shutdown(self):
+        self.join()
+        for pool in self._pools.values():
+            pool.shutdown()
@@ -0,0 +1,219 @@
+"""Spool directory for incoming Sonarr/Radarr webhook events.
+
+Every event is its own JSON file under ``<spool>/<kind>/`` so a burst of
+webhooks can never overwrite each other. Writers should use `spool_event`,
+which writes to a hidden temporary name and renames the file into place.
+The daemon claims an event by renaming it into ``<spool>/processing/``
+before reading it, so two readers never process the same event and a
+claimed event survives a crash until `recover` puts it back.
+"""
+
+import ctypes, ctypes.util, json, os, select, shutil, sys, time, uuid
+from collections import namedtuple
+
+KINDS = ("sonarr", "radarr", "uhd_radarr")
+
+SpoolEvent = namedtuple("SpoolEvent", ["kind", "path"])
+
+# Seconds a file must be untouched before an unreadable payload is treated as
+# broken rather than as still being written.
+_SETTLE_TIME = 5
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+
+def _event_name():
+    return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+
+
+def spool_event(spool_dir, kind, data):
+    """Atomically add an event to the spool.
+
+    Arguments:
+        spool_dir (str): The root of the spool directory.
+        kind (str): One of `KINDS`.
+        data (dict): The webhook payload.
+
+    Returns:
+        str: The path of the spooled event file.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown event kind {kind}")
+    kind_dir = os.path.join(spool_dir, kind)
+    os.makedirs(kind_dir, exist_ok=True)
+    name = _event_name()
+    tmp_path = os.path.join(kind_dir, f".{name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    final_path = os.path.join(kind_dir, name)
+    os.rename(tmp_path, final_path)
+    return final_path
+
+
+class _Inotify:
+    """Minimal inotify wrapper used to wake the spool as soon as a file lands."""
+
+    def __init__(self, directories):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JobSpool:
+    """Claims webhook events from a spool directory.
+
+    Arguments:
+        spool_dir (str): The root of the spool directory.
+        legacy_files (dict): Optional mapping of kind to a fixed file path that
+            older webhook scripts still write to. Those files are adopted into
+            the spool as soon as they appear.
+        poll_interval (float): How long to sleep between scans when inotify is
+            unavailable, and the upper bound on an inotify wait.
+    """
+
+    def __init__(self, spool_dir, legacy_files=None, poll_interval=0.5):
+        self.spool_dir = spool_dir
+        self.processing_dir = os.path.join(spool_dir, "processing")
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.legacy_files = {kind: p for kind, p in (legacy_files or {}).items() if p}
+        self.poll_interval = poll_interval
+        for directory in [self.processing_dir, self.failed_dir] + [os.path.join(spool_dir, k) for k in KINDS]:
+            os.makedirs(directory, exist_ok=True)
+
+        watched = {os.path.join(spool_dir, k) for k in KINDS}
+        watched.update(os.path.dirname(os.path.abspath(p)) for p in self.legacy_files.values())
+        try:
+            self._watcher = _Inotify(sorted(watched))
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), polling the spool every {poll_interval}s")
+            self._watcher = None
+
+    def recover(self):
+        """Return events left in processing/ by a previous run to the spool."""
+        for name in os.listdir(self.processing_dir):
+            kind, _, original = name.partition("__")
+            if kind not in KINDS:
+                continue
+            os.rename(os.path.join(self.processing_dir, name), os.path.join(self.spool_dir, kind, original))
+            print(f"Recovered spooled {kind} event {original}")
+
+    def _adopt_legacy(self):
+        for kind, legacy_path in self.legacy_files.items():
+            if not os.path.exists(legacy_path):
+                continue
+            target = os.path.join(self.spool_dir, kind, _event_name())
+            try:
+                os.rename(legacy_path, target)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                # Different filesystem: copy under a hidden name, then rename into place.
+                tmp_path = os.path.join(self.spool_dir, kind, f".{os.path.basename(target)}.tmp")
+                shutil.move(legacy_path, tmp_path)
+                os.rename(tmp_path, target)
+
+    def claim(self):
+        """Claim every event currently in the spool.
+
+        Returns:
+            list: `SpoolEvent` tuples, oldest first across all kinds. Which job
+                runs first is up to the pipeline's scheduler.
+        """
+        self._adopt_legacy()
+        claimed = []
+        for kind in KINDS:
+            kind_dir = os.path.join(self.spool_dir, kind)
+            for name in os.listdir(kind_dir):
+                if name.startswith(".") or not name.endswith(".json"):
+                    continue
+                target = os.path.join(self.processing_dir, f"{kind}__{name}")
+                try:
+                    os.rename(os.path.join(kind_dir, name), target)
+                except FileNotFoundError:
+                    continue
+                claimed.append((name, SpoolEvent(kind, target)))
+        # Event names start with their arrival time
+        return [event for _, event in sorted(claimed)]
+
+    def read(self, event):
+        """Load the payload of a claimed event.
+
+        A payload that does not parse yet is put back if the file was written
+        recently, otherwise it is moved to failed/ so it cannot block the spool.
+        So is valid JSON that is not an object, which no job could use.
+
+        Returns:
+            dict: The payload, or None if it could not be read.
+        """
+        original = os.path.basename(event.path).partition("__")[2]
+        try:
+            with open(event.path) as f:
+                data = json.load(f)
+        except ValueError as e:
+            # Invalid JSON or invalid UTF-8, which may just be a payload still being written
+            try:
+                if time.time() - os.path.getmtime(event.path) < _SETTLE_TIME:
+                    os.rename(event.path, os.path.join(self.spool_dir, event.kind, original))
+                    return None
+            except OSError:
+                pass
+            self.fail(event, f"Unreadable {event.kind} event {original}: {e}")
+        except OSError as e:
+            self.fail(event, f"Cannot read {event.kind} event {original}: {e}")
+        else:
+            if isinstance(data, dict):
+                return data
+            self.fail(event, f"Unreadable {event.kind} event {original}: expected a JSON object, got {type(data).__name__}")
+        return None
+
+    def fail(self, event, reason):
+        """Move a claimed event to failed/ so it is kept for inspection but never retried."""
+        print(reason)
+        try:
+            os.rename(event.path, os.path.join(self.failed_dir, os.path.basename(event.path)))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, event):
+        """Remove a claimed event once it has been handed off."""
+        try:
+            os.remove(event.path)
+        except FileNotFoundError:
+            pass
+
+    def wait(self):
+        """Block until something may have arrived in the spool."""
+        if self._watcher is None:
+            time.sleep(self.poll_interval)
+        else:
+            self._watcher.wait(self.poll_interval)
+
+
+if __name__ == "__main__":
+    # Usage from a webhook script: job_spool.py <spool_dir> <kind> < payload.json
+    print(spool_event(sys.argv[1], sys.argv[2], json.load(sys.stdin)))
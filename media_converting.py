@@ -1,12 +1,105 @@
-import os, subprocess, shlex
+import os, subprocess, shlex, json, threading
+from collections import OrderedDict
 
-def convert(video_file, sickbeard_path, python_path):
+# Streams Plex direct-plays from an MP4/M4V container
+DIRECT_PLAY_VIDEO = {"h264"}
+DIRECT_PLAY_AUDIO = {"aac"}
+# Subtitle codecs that can be carried into MP4 as mov_text
+TEXT_SUBTITLES = {"subrip", "ass", "ssa", "webvtt", "mov_text", "text"}
+MP4_EXTENSIONS = {".mp4", ".m4v"}
+
+_probe_cache = OrderedDict()
+_probe_cache_lock = threading.Lock()
+_PROBE_CACHE_SIZE = 512
+
+def probe_media(video_file, ffprobe_path):
+    """Read the container and stream information of a video file with ffprobe.
+
+    Results are cached per file, keyed by path, size and modification time.
+
+    Arguments:
+        video_file (str): The path to the video file.
+        ffprobe_path (str): The path to the ffprobe executable.
+
+    Returns:
+        dict: ffprobe's JSON output with "format" and "streams".
+
+    Raises:
+        subprocess.CalledProcessError: If ffprobe cannot read the file.
+    """
+    stat = os.stat(video_file)
+    key = (video_file, stat.st_size, stat.st_mtime_ns)
+    with _probe_cache_lock:
+        if key in _probe_cache:
+            _probe_cache.move_to_end(key)
+            return _probe_cache[key]
+
+    command = [ffprobe_path, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", video_file]
+    result = subprocess.run(command, check=True, capture_output=True)
+    probe = json.loads(result.stdout)
+
+    with _probe_cache_lock:
+        _probe_cache[key] = probe
+        while len(_probe_cache) > _PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return probe
+
+def plan_conversion(video_file, probe):
+    """Decide how much work a file needs to become direct-play compatible.
+
+    Arguments:
+        video_file (str): The path to the video file.
+        probe (dict): The output of `probe_media`.
+
+    Returns:
+        str: "skip" if the file is already an H.264/AAC MP4, "remux" if only the
+        container needs to change, otherwise "transcode".
+    """
+    streams = probe.get("streams", [])
+    codecs = {kind: {s.get("codec_name") for s in streams if s.get("codec_type") == kind}
+              for kind in ("video", "audio", "subtitle")}
+    if not codecs["video"] or not codecs["video"] <= DIRECT_PLAY_VIDEO:
+        return "transcode"
+    if not codecs["audio"] or not codecs["audio"] <= DIRECT_PLAY_AUDIO:
+        return "transcode"
+    if not codecs["subtitle"] <= TEXT_SUBTITLES:
+        return "transcode"
+    is_mp4 = os.path.splitext(video_file)[1].lower() in MP4_EXTENSIONS and "mp4" in probe.get("format", {}).get("format_name", "")
+    if is_mp4 and codecs["subtitle"] <= {"mov_text"}:
+        return "skip"
+    return "remux"
+
+def _remux(video_file, new_path, ffmpeg_path, run=subprocess.run):
+    """Copy the streams of a compatible file into an M4V container without re-encoding."""
+    tmp_path = f"{os.path.splitext(new_path)[0]}.remux.m4v"
+    command = [ffmpeg_path, "-v", "error", "-y", "-i", video_file, "-map", "0:v", "-map", "0:a", "-map", "0:s?",
+               "-c", "copy", "-c:s", "mov_text", "-movflags", "+faststart", tmp_path]
+    try:
+        run(command, check=True)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, new_path)
+    if os.path.abspath(video_file) != os.path.abspath(new_path):
+        os.remove(video_file)
+
+def convert(video_file, sickbeard_path, python_path, ffprobe_path=None, ffmpeg_path=None, run=subprocess.run):
     """Convert a video file to an M4V file using the Sickbeard library.
 
+    When `ffprobe_path` is given the file is probed first. Files that are already
+    H.264/AAC in an MP4 container are only renamed to .m4v, files with compatible
+    streams in another container are remuxed with ffmpeg, and only the rest go
+    through a full Sickbeard transcode.
+
     Arguments:
         video_file (str): The path to the video file to be converted.
         sickbeard_path (str): The path to the Sickbeard MP4 Automator script.
         python_path (str): The path to the Python interpreter.
+        ffprobe_path (str): Optional path to ffprobe, enables the fast path.
+        ffmpeg_path (str): The path to ffmpeg, used for remuxing.
+        run (callable): Runs the ffmpeg and Sickbeard commands, like subprocess.run. A
+            Cancellation's run lets a superseded job stop them.
 
     Returns:
         str: The path to the converted M4V file, or None if the conversion failed.
@@ -15,16 +108,36 @@ def convert(video_file, sickbeard_path, python_path):
         FileNotFoundError: If `video_file` does not exist.
         subprocess.CalledProcessError: If the conversion fails.
     """
-    
-    print("Converting...")
 
     base, ext = os.path.splitext(video_file)
     new_path = f"{base}.m4v"
+
+    plan = "transcode"
+    if ffprobe_path:
+        try:
+            plan = plan_conversion(video_file, probe_media(video_file, ffprobe_path))
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            print(f"Could not probe {video_file}, transcoding: {e}")
+    print(f"Conversion plan for {video_file}: {plan}")
+
+    if plan == "skip":
+        if video_file != new_path:
+            os.rename(video_file, new_path)
+        return new_path
+    if plan == "remux":
+        try:
+            _remux(video_file, new_path, ffmpeg_path or "ffmpeg", run)
+            return new_path
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"Remux failed, transcoding instead: {e}")
+
+    print("Converting...")
+
     video_file = shlex.quote(video_file)
     command = f"{python_path} {sickbeard_path} -i {video_file} -a"
     print(command)
     try:
-        subprocess.run(command, shell=True, check=True)
+        run(command, shell=True, check=True)
     except subprocess.CalledProcessError as e:
         return None
-    return new_path
\ No newline at end of file
+    return new_path
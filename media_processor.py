@@ -1,108 +1,306 @@
 #!/usr/bin/env python3
 
-import yaml, threading, os, json, time
-from concurrent.futures import ThreadPoolExecutor
+import argparse, asyncio, os
+from concurrent.futures import Future
 from datetime import date
 
 #Now imports from this project
 from media_converting import convert
-from media_uploader import upload_to_rclone
-from movie_sorting import get_movie_data, determine_movie_path, move_movie, movie_directory
-from plex_operations import update_plex, plex_library, create_plex_server, plex_path, get_plex_data
+from media_uploader import RemoteScheduler, UploadBatcher
+from movie_sorting import get_movie_data, determine_movie_path, move_movie, movie_directory, OMDB_URL
+from plex_operations import plex_library, PlexClient, plex_path, PlexLibrarySyncer, PlexRefreshCoalescer
 from rr_operations import remove_movie_from_radarr
+from job_spool import JobSpool
+from job_journal import JobJournal
+from job_pipeline import Pipeline, PriorityScheduler, Step
+from job_async import AsyncRunner
+import resilient_http
+from plex_store import PlexStore
+from metadata_cache import MetadataCache
+from job_metrics import JobMetrics
+from sorting_rules import SortingRules
+from file_mover import FileMover
+from settings import load_settings, SettingsWatcher
+from convert_queue import ConvertQueue, ConvertWorker
+from job_fingerprint import identify, media_path
+from disk_admission import DiskAdmission
 
-#Load and assign the starting variables
-with open("config/config.yaml", "r") as f:
-    config = yaml.safe_load(f)
-
-remotes = config["remotes"]
-plex_server = config["plex_server"]
-plex_token = config["plex_token"]
-uhd_radarr_data = config["uhd_radarr_data"]
-radarr_data = config["radarr_data"]
-sonarr_data = config["sonarr_data"]
-rclone_log_file =  config["rclone_log_file"] + str(date.today()) + ".log"
-radarr_url = config["radarr_url"]
-uhd_radarr_url = config["uhd_radarr_url"]
-radarr_api = config["radarr_api"]
-uhd_radarr_api = config["uhd_radarr_api"]
-sickbeard_path = config["sickbeard_path"]
-python_path = config["python_path"]
-rclone_state_file = config["rclone_state"]
-rclone_path = config["rclone_path"]
-tmdb_api = config["tmdb_api"]
-omdb_api = config["omdb_api"]
-plex_base_path = config["plex_base_path"]
-uhd_dir = config["uhd_base_path"] 
-movie_dir = config["movie_base_path"]
-base_path = config["base_path"]
-threads = int(config["threads"])
-libraries = config["libraries"]
-plex_base_path = config["plex_base_path"]
-
-rclone_state_lock = threading.Lock()
-plex_data_lock = threading.Lock()
-
-def tv_process(tv_json):
-  print(f"Processing {tv_json['seriestitle']} Season {tv_json['season_number']} Episode {tv_json['ep_number']}")
-  full_path = os.path.join(base_path, tv_json["epidodepath"][1:])
-  converted_path = convert(full_path, sickbeard_path, python_path)
-  upload_to_rclone(converted_path, remotes, base_path, rclone_state_file, rclone_path, rclone_state_lock, rclone_log_file )
-  plex_media_path = plex_path(converted_path, plex_base_path, base_path)
-  library_id = plex_library(plex_media_path, libraries)
+parser = argparse.ArgumentParser(description="Converts, sorts and uploads Sonarr and Radarr downloads and refreshes Plex")
+parser.add_argument("--config", default="config/config.yaml")
+parser.add_argument("--worker", action="store_true", help="Only convert files from the shared convert_queue, on an extra transcoding host")
+args = parser.parse_args()
+
+#Load and validate the settings, see settings.py for every key and its default
+config_path = args.config
+settings = load_settings(config_path)
+
+# Scheduling class of each job kind, see job_priorities and job_class_limits in config.yaml
+JOB_CLASSES = {"sonarr": "tv", "radarr": "movie", "uhd_radarr": "uhd"}
+
+def convert_file(full_path, cancellation):
+  converted_path = convert(full_path, settings.sickbeard_path, settings.python_path, settings.ffprobe_path, settings.ffmpeg_path, cancellation.run)
+  print(converted_path)
+  if converted_path is None:
+    raise RuntimeError(f"Conversion failed for {full_path}")
+  return converted_path
+
+def convert_scheduler():
+  return PriorityScheduler(JOB_CLASSES, settings.job_priorities, settings.job_class_limits, settings.job_priority_aging)
+
+def convert_worker(scheduler):
+  return ConvertWorker(os.path.join(settings.base_path, settings.convert_queue), settings.base_path, convert_file, settings.convert_threads, settings.convert_lease, scheduler)
+
+def run_worker():
+  """Converts files from the shared queue for a coordinator on another host, see convert_queue.py"""
+  if not settings.convert_queue:
+    raise SystemExit("--worker needs convert_queue set in config.yaml")
+  scheduler = convert_scheduler()
+  worker = convert_worker(scheduler)
+  watcher = SettingsWatcher(config_path, settings)
+  def apply(old, new):
+    global settings
+    settings = new
+    scheduler.configure(new.job_priorities, new.job_class_limits, new.job_priority_aging)
+    worker.set_slots(new.convert_threads)
+  watcher.subscribe(apply)
+  watcher.start()
+  worker.run()
+
+if args.worker:
+  run_worker()
+
+rclone_log_file = settings.rclone_log_file + str(date.today()) + ".log"
+
+resilient_http.configure(settings.http_services)
+metrics = JobMetrics(settings.metrics_log)
+job_scheduler = convert_scheduler()
+remote_scheduler = RemoteScheduler(settings.remotes, settings.rclone_state, settings.remote_daily_quota, settings.remote_error_cooldown)
+uploader = UploadBatcher(remote_scheduler, settings.base_path, settings.rclone_path, rclone_log_file, settings.upload_batch_window, settings.upload_batch_max_delay, settings.upload_batch_max_files, settings.upload_threads, metrics, job_scheduler)
+journal = JobJournal(settings.journal_path)
+plex_store = PlexStore(settings.plex_store_path)
+metadata_cache = MetadataCache(settings.metadata_cache_path, settings.metadata_cache_ttl, settings.metadata_cache_size)
+sorting_rules = SortingRules(settings.sorting_rules)
+mover = FileMover(settings.move_copies_per_disk, settings.move_verify)
+runner = AsyncRunner({"radarr": settings.radarr_concurrency, "metadata": settings.metadata_concurrency, "disk": settings.move_concurrency})
+plex = PlexClient(settings.plex_server, settings.plex_token, settings.plex_pool_size)
+plex_syncer = PlexLibrarySyncer(plex, plex_store, settings.libraries, settings.plex_sync_interval, metrics)
+plex_refresher = PlexRefreshCoalescer(plex, settings.plex_refresh_window, settings.plex_refresh_max_delay, metrics)
+disk_admission = DiskAdmission(settings.base_path, settings.staging_headroom, settings.staging_output_ratio, settings.staging_max_wait, uploader.flush)
+convert_queue = ConvertQueue(os.path.join(settings.base_path, settings.convert_queue), settings.convert_lease) if settings.convert_queue else None
+
+def _convert(job, media_path):
+  if convert_queue is not None:
+    return _queue_convert(job, media_path)
+  full_path = os.path.join(settings.base_path, media_path[1:])
+  print(full_path)
+  job.state["converted_path"] = convert_file(full_path, job.cancellation)
+
+def _queue_convert(job, media_path):
+  """Hands the conversion to whichever host's worker claims it, returns a Future for the pipeline"""
+  converted = Future()
+  def done(task):
+    try:
+      job.state["converted_path"] = os.path.join(settings.base_path, task.result())
+    except Exception as e:
+      converted.set_exception(e)
+    else:
+      print(job.state["converted_path"])
+      converted.set_result(None)
+  print(f"Queued {media_path} for conversion")
+  task_id = f"job-{job.id}"
+  convert_queue.submit(task_id, media_path[1:], JOB_CLASSES.get(job.kind, job.kind)).add_done_callback(done)
+  job.cancellation.on_cancel(lambda: convert_queue.cancel(task_id, job.cancellation.reason))
+  return converted
+
+def _upload(job, local_path):
+  uploaded = uploader.submit(local_path, JOB_CLASSES.get(job.kind, job.kind))
+  job.cancellation.on_cancel(lambda: uploader.cancel(local_path, job.cancellation.reason))
+  return uploaded
+
+def _refresh_plex(local_path):
+  plex_media_path = plex_path(local_path, settings.plex_base_path, settings.base_path)
   plex_media_path, file_name = os.path.split(plex_media_path)
-  update_plex(library_id, plex_media_path, create_plex_server(plex_server, plex_token))
+  library_id = plex_library(plex_media_path, settings.libraries)
+  # The job only completes its refresh step once Plex has taken the refresh, so a restart or a failure retries it
+  return asyncio.wrap_future(plex_refresher.request(library_id, plex_media_path))
+
+def convert_space(job):
+  """The staging disk space a job's conversion is expected to write, and the file it writes it next to"""
+  source_path = os.path.join(settings.base_path, media_path(job.kind, job.payload))
+  return disk_admission.estimate(source_path), source_path
+
+def tv_convert(job):
+  tv_json = job.payload
+  print(f"Processing {tv_json['seriestitle']} Season {tv_json['season_number']} Episode {tv_json['ep_number']}")
+  return _convert(job, tv_json["epidodepath"])
+
+def tv_upload(job):
+  return _upload(job, job.state["converted_path"])
+
+async def tv_refresh_plex(job):
+  tv_json = job.payload
+  await _refresh_plex(job.state["converted_path"])
   print(f"{tv_json['seriestitle']} Season {tv_json['season_number']} Episode {tv_json['ep_number']} Has been processed and added to Plex")
-  
-def movie_process(movie_json, isUHD):
+
+async def movie_remove_from_radarr(job):
+  movie_json = job.payload
   print(f"Processing {movie_json['movietitle']}")
-  plex = create_plex_server(plex_server, plex_token)
-  if isUHD:
-    remove_movie_from_radarr(movie_json["movieid"], uhd_radarr_url, uhd_radarr_api)
+  if job.kind == "uhd_radarr":
+    await runner.call("radarr", remove_movie_from_radarr, movie_json["movieid"], settings.uhd_radarr_url, settings.uhd_radarr_api)
   else:
-    remove_movie_from_radarr(movie_json["movieid"], radarr_url, radarr_api)
-  full_path = os.path.join(base_path, movie_json["moviepath"][1:])
-  print(full_path)
-  converted_path = convert(full_path, sickbeard_path, python_path)
-  print(converted_path)
-  movie_data = get_movie_data(movie_json["tmdbid"], movie_json["imdbid"], tmdb_api, omdb_api)
-  with plex_data_lock:
-    get_plex_data(plex)
-    sorted_path = determine_movie_path(movie_data, base_path, plex_base_path, converted_path, movie_directory(isUHD, uhd_dir, movie_dir))
+    await runner.call("radarr", remove_movie_from_radarr, movie_json["movieid"], settings.radarr_url, settings.radarr_api)
+
+def movie_convert(job):
+  return _convert(job, job.payload["moviepath"])
+
+def _sort_and_move(job, movie_data):
+  isUHD = job.kind == "uhd_radarr"
+  converted_path = job.state["converted_path"]
+  with metrics.timed(job, "sort"):
+    sorted_path = determine_movie_path(movie_data, settings.base_path, settings.plex_base_path, converted_path, movie_directory(isUHD, settings.uhd_base_path, settings.movie_base_path), plex_store, sorting_rules)
   print(sorted_path)
-  move_movie(converted_path, sorted_path)
-  if 'unknown' in sorted_path:
+  with metrics.timed(job, "move"):
+    move_movie(converted_path, sorted_path, mover)
+  return sorted_path
+
+async def movie_sort(job):
+  movie_json = job.payload
+  with metrics.timed(job, "metadata"):
+    movie_data = await runner.call("metadata", get_movie_data, movie_json["tmdbid"], movie_json["imdbid"], settings.tmdb_api, settings.omdb_api, metadata_cache, settings.tmdb_url, settings.omdb_url or OMDB_URL)
+  if not (await runner.wait_event(plex_syncer.ready, settings.plex_sync_wait) and plex_syncer.synced):
+    print("Plex library has not synced yet, sorting without it")
+  job.state["sorted_path"] = await runner.call("disk", _sort_and_move, job, movie_data)
+
+def movie_upload(job):
+  if 'unknown' in job.state["sorted_path"]:
+    return False
+  return _upload(job, job.state["sorted_path"])
+
+async def movie_refresh_plex(job):
+  await _refresh_plex(job.state["sorted_path"])
+  plex_syncer.request_sync()
+  print(f"{job.payload['movietitle']} has been proicessed and added to Plex")
+
+TV_STEPS = [
+  Step("converted", "convert", tv_convert, convert_space),
+  Step("uploaded", "upload", tv_upload),
+  Step("plex_refreshed", "async", tv_refresh_plex),
+]
+
+MOVIE_STEPS = [
+  Step("radarr_removed", "async", movie_remove_from_radarr),
+  Step("converted", "convert", movie_convert, convert_space),
+  Step("sorted", "async", movie_sort),
+  Step("uploaded", "upload", movie_upload),
+  Step("plex_refreshed", "async", movie_refresh_plex),
+]
+
+def submit_job(pipeline, job):
+  pipeline.submit(job, TV_STEPS if job.kind == "sonarr" else MOVIE_STEPS)
+
+def remove_leftovers(job):
+  """Deletes the converted or sorted file a cancelled job left under base_path. A file another running
+  job uses, or one written since the cancel, may belong to the job that superseded it and is kept"""
+  in_use = set()
+  for other in journal.pending():
+    relative = media_path(other.kind, other.payload)
+    if relative:
+      in_use.add(os.path.realpath(os.path.join(settings.base_path, relative)))
+    in_use.update(os.path.realpath(other.state[key]) for key in ("converted_path", "sorted_path") if other.state.get(key))
+  base = os.path.realpath(settings.base_path)
+  for key in ("converted_path", "sorted_path"):
+    path = job.state.get(key)
+    if not path or not os.path.isfile(path):
+      continue
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([base, real_path]) != base:
+      continue
+    if real_path in in_use or os.path.getmtime(real_path) >= job.cancellation.cancelled_at:
+      print(f"Keeping {path} left by cancelled job {job.id}, it may belong to a newer job")
+      continue
+    os.remove(real_path)
+    print(f"Removed {path} left by cancelled job {job.id}")
+
+def admit(pipeline, kind, data, event_key):
+  """Journals and starts a job for a webhook event, unless it is a re-fire of a file already handled.
+  A newer file for the same episode or movie cancels the older jobs still running for it"""
+  media_key, fingerprint = identify(kind, data, settings.base_path)
+  duplicate = journal.duplicate_of(media_key, fingerprint)
+  if duplicate is not None:
+    print(f"Dropping {kind} event {event_key}, the same file as job {duplicate}")
     return
-  upload_to_rclone(sorted_path, remotes, base_path, rclone_state_file, rclone_path, rclone_state_lock, rclone_log_file)
-  plex_media_path = plex_path(sorted_path, plex_base_path, base_path)
-  plex_media_path, file_name = os.path.split(plex_media_path)
-  library_id = plex_library(plex_media_path, libraries)
-  update_plex(library_id, plex_media_path, create_plex_server(plex_server, plex_token))
-  print(f"{movie_json['movietitle']} has been proicessed and added to Plex")
-  
- 
-  
-  
+  job, created = journal.add(kind, data, event_key, media_key, fingerprint)
+  if not created:
+    return
+  for old in journal.superseded_by(job):
+    reason = f"superseded by job {job.id}"
+    print(f"Cancelling job {old}, {reason}")
+    pipeline.cancel(old, reason)
+  submit_job(pipeline, job)
+
+def apply_settings(pipeline, spool, worker=None):
+  """Returns a SettingsWatcher listener that applies reloaded settings to the running daemon"""
+  def apply(old, new):
+    global settings
+    # Step functions read the module-level settings when they run, so new jobs and steps see new values
+    settings = new
+    pipeline.resize({"convert": new.convert_threads, "upload": new.upload_threads})
+    if worker is not None:
+      worker.set_slots(new.convert_threads)
+    spool.poll_interval = new.spool_poll_interval
+    uploader.rclone_path = new.rclone_path
+    pipeline.scheduler.configure(new.job_priorities, new.job_class_limits, new.job_priority_aging)
+    pipeline.reschedule()
+    uploader.reschedule()
+    if new.upload_threads != old.upload_threads:
+      uploader.set_workers(new.upload_threads)
+    if new.remotes != old.remotes:
+      remote_scheduler.set_remotes(new.remotes)
+    if new.libraries != old.libraries:
+      plex_syncer.set_libraries(new.libraries)
+    plex_syncer.interval = new.plex_sync_interval
+    plex_refresher.window, plex_refresher.max_delay = new.plex_refresh_window, new.plex_refresh_max_delay
+    uploader.window, uploader.max_delay, uploader.max_files = new.upload_batch_window, new.upload_batch_max_delay, new.upload_batch_max_files
+    disk_admission.headroom, disk_admission.output_ratio, disk_admission.max_wait = new.staging_headroom, new.staging_output_ratio, new.staging_max_wait
+  return apply
 
 def main():
-  with ThreadPoolExecutor(max_workers=threads) as executor:
-    while True:
-      if os.path.exists(sonarr_data):
-        with open(sonarr_data) as f:
-          data = json.load(f)
-          executor.submit(tv_process, data)
-        os.remove(sonarr_data)
-      elif os.path.exists(radarr_data):
-        with open(radarr_data) as f:
-          data = json.load(f)
-          executor.submit(movie_process, data, False)
-        os.remove(radarr_data)
-      elif os.path.exists(uhd_radarr_data):
-        with open(uhd_radarr_data) as f:
-          data = json.load(f)
-          executor.submit(movie_process, data, True)
-        os.remove(uhd_radarr_data)
-      else:
-        time.sleep(0.5)
+  spool = JobSpool(settings.spool_directory, {"sonarr": settings.sonarr_data, "radarr": settings.radarr_data, "uhd_radarr": settings.uhd_radarr_data}, settings.spool_poll_interval)
+  spool.recover()
+  plex_syncer.start()
+  plex_refresher.start()
+  uploader.start()
+  worker = None
+  if convert_queue is not None:
+    # This host converts too, taking its turn in the shared queue like any other worker
+    convert_queue.start()
+    worker = convert_worker(job_scheduler)
+    worker.start()
+    metrics.add_gauges(convert_queue.gauges)
+  pipeline = Pipeline({"convert": settings.convert_threads, "upload": settings.upload_threads}, journal, metrics, runner, job_scheduler, disk_admission, remove_leftovers)
+  disk_admission.subscribe(pipeline.reschedule)
+  disk_admission.start()
+  watcher = SettingsWatcher(config_path, settings)
+  watcher.subscribe(apply_settings(pipeline, spool, worker))
+  watcher.start()
+  metrics.add_gauges(pipeline.gauges)
+  metrics.add_gauges(runner.gauges)
+  metrics.add_gauges(resilient_http.gauges)
+  metrics.add_gauges(uploader.gauges)
+  metrics.add_gauges(plex_refresher.gauges)
+  metrics.add_gauges(disk_admission.gauges)
+  if settings.metrics_port:
+    metrics.serve(settings.metrics_port)
+  for job in journal.pending():
+    print(f"Resuming job {job.id} after stage {job.stage}")
+    submit_job(pipeline, job)
+  while True:
+    for event in spool.claim():
+      data = spool.read(event)
+      if data is None:
+        continue
+      admit(pipeline, event.kind, data, os.path.basename(event.path))
+      spool.complete(event)
+    spool.wait()
   
 main()
\ No newline at end of file
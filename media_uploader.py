@@ -1,58 +1,391 @@
-import json, shlex, subprocess, logging
+import json, shutil, subprocess, logging, os, tempfile, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
 from os import path
+from job_cancel import Cancellation, JobCancelled
 
-def upload_to_rclone(local_path, remotes, local_base, state_file, rclone_path, rclone_lock, log_file):
+class RemoteScheduler:
     """
-    Uploads the local file to the remote using rclone, rotating the remote each time based on the state stored in the state file.
+    Chooses which rclone remote each upload goes to.
 
-    :param local_path: The path of the local file to be uploaded
-    :param remotes: The list of remotes to rotate
-    :param local_base: The base directory of the local files
+    The scheduler tracks the uploads in flight, the bytes uploaded today, the recent throughput and the
+    recent errors of every remote, and hands each upload to the least loaded healthy remote. Remotes that
+    just failed are rested for `error_cooldown` seconds and remotes that would exceed `daily_quota` bytes
+    are skipped, unless no other remote is available. The per-remote state is saved atomically to the
+    state file so quotas survive a restart.
+
+    :param remotes: The list of remotes to schedule across
     :param state_file: The file to store the state in
+    :param daily_quota: The number of bytes a remote may take per day, or None for no limit
+    :param error_cooldown: How long, in seconds, a remote is avoided after a failed upload
+    """
+
+    def __init__(self, remotes, state_file, daily_quota=None, error_cooldown=300):
+        if not remotes:
+            raise ValueError("The list of remotes cannot be empty.")
+        self.remotes = list(remotes)
+        self.state_file = state_file
+        self.daily_quota = daily_quota
+        self.error_cooldown = error_cooldown
+        self._lock = threading.Lock()
+        self._in_flight = {remote: 0 for remote in self.remotes}
+        self._state = {remote: self._empty_state() for remote in self.remotes}
+        self._load()
+
+    @staticmethod
+    def _empty_state():
+        return {"day": str(date.today()), "uploaded_today": 0, "throughput": 0.0, "errors": 0, "resting_until": 0}
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r") as f:
+                saved = json.load(f).get("remotes", {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for remote, state in saved.items():
+            if remote in self._state:
+                self._state[remote].update(state)
+
+    def _save(self):
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"remotes": self._state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.state_file)
+
+    def _roll_day(self, state):
+        today = str(date.today())
+        if state["day"] != today:
+            state["day"] = today
+            state["uploaded_today"] = 0
+
+    def set_remotes(self, remotes):
+        """
+        Replaces the list of remotes uploads are scheduled across. Uploads already running on a
+        removed remote finish normally.
+
+        :param remotes: The new list of remotes
+        """
+        if not remotes:
+            raise ValueError("The list of remotes cannot be empty.")
+        with self._lock:
+            for remote in remotes:
+                self._in_flight.setdefault(remote, 0)
+                self._state.setdefault(remote, self._empty_state())
+            self.remotes = list(remotes)
+
+    def acquire(self, size):
+        """
+        Reserves the best remote for an upload of `size` bytes.
+
+        :param size: The size of the upload in bytes
+        :return: The chosen remote, to be passed back to release()
+        """
+        with self._lock:
+            now = time.time()
+            candidates = []
+            for remote in self.remotes:
+                state = self._state[remote]
+                self._roll_day(state)
+                healthy = state["resting_until"] <= now
+                has_quota = self.daily_quota is None or state["uploaded_today"] + size <= self.daily_quota
+                candidates.append((not (healthy and has_quota), self._in_flight[remote], state["errors"],
+                                   state["uploaded_today"], -state["throughput"], remote))
+            remote = min(candidates)[-1]
+            self._in_flight[remote] += 1
+            return remote
+
+    def release(self, remote, size, seconds, ok):
+        """
+        Records the outcome of an upload started with acquire().
+
+        :param remote: The remote returned by acquire()
+        :param size: The number of bytes uploaded
+        :param seconds: How long the upload took
+        :param ok: Whether the upload succeeded, or None if it was cancelled, which counts neither way
+        """
+        with self._lock:
+            self._in_flight[remote] -= 1
+            state = self._state[remote]
+            self._roll_day(state)
+            if ok:
+                state["uploaded_today"] += size
+                state["errors"] = 0
+                if seconds > 0:
+                    rate = size / seconds
+                    state["throughput"] = rate if not state["throughput"] else 0.7 * state["throughput"] + 0.3 * rate
+            elif ok is not None:
+                state["errors"] += 1
+                state["resting_until"] = time.time() + self.error_cooldown * state["errors"]
+            self._save()
+
+def _rclone_move(rclone_path, source, destination, log_file, files_from=None, delete_empty_src_dirs=False, run=subprocess.run):
+    """
+    Runs a single rclone move and raises if it fails.
+
+    :param rclone_path: The path to the rclone executable
+    :param source: The local file or directory to move
+    :param destination: The remote path to move to
+    :param log_file: The file to log the results to
+    :param files_from: Optional file listing the paths, relative to source, to move
+    :param delete_empty_src_dirs: Remove the source directories the move leaves empty
+    :param run: Runs rclone, like subprocess.run; a Cancellation's run lets the move be stopped
+    """
+    command = [rclone_path, "move", source, destination, "-v", "--stats=5s", "--log-file", log_file]
+    if files_from:
+        command += ["--files-from", files_from]
+    if delete_empty_src_dirs:
+        command.append("--delete-empty-src-dirs")
+    result = run(command, capture_output=True)
+    print(result.stdout)
+    print(result.stderr)
+    if result.returncode != 0:
+        raise RuntimeError(f"rclone exited with status {result.returncode} moving {source} to {destination}")
+
+def _check_rclone(local_base, rclone_path):
+    if not path.isdir(local_base):
+        raise ValueError(f"The local base directory {local_base} does not exist.")
+    if not shutil.which(rclone_path):
+        raise ValueError(f"The rclone executable {rclone_path} does not exist.")
+
+class _ReadyBatch:
+    """A batch whose window has closed, waiting for a free upload worker."""
+
+    def __init__(self, job_class, queued_at, directory, files):
+        self.job_class = job_class
+        self.queued_at = queued_at
+        self.directory = directory
+        self.files = files
+
+class UploadBatcher:
+    """
+    Groups uploads headed to the same directory into one rclone call.
+
+    Files submitted for the same local directory are held until no new file has arrived for `window`
+    seconds, `max_delay` has passed, or `max_files` are waiting. The group is then moved with a single
+    `rclone move --files-from` to one remote, so a season pack pays rclone's startup, authentication and
+    directory listing once instead of once per episode. Batches run on their own pool of `workers` threads;
+    when more are ready than there are workers, `priorities` picks the next one by job class, priority and
+    age, and caps how many workers of the `upload` pool a class may hold.
+
+    :param scheduler: The RemoteScheduler that picks the remote for each batch
+    :param local_base: The base directory of the local files
     :param rclone_path: The path to the rclone executable
-    :param rclone_lock: The lock used to synchronize access to the state file
     :param log_file: The file to log the results to
+    :param window: Seconds of quiet before a directory's batch is sent
+    :param max_delay: The longest a file is held back
+    :param max_files: The most files sent in one batch
+    :param workers: The number of batches uploaded at once
+    :param metrics: Optional JobMetrics to report batch timings and bytes uploaded to
+    :param priorities: Optional PriorityScheduler ordering the ready batches, first come, first served without
     """
-    try:
-        # Validate inputs
+
+    def __init__(self, scheduler, local_base, rclone_path, log_file, window, max_delay, max_files, workers, metrics=None, priorities=None):
+        self.scheduler = scheduler
+        self.priorities = priorities
+        self.metrics = metrics
+        self.local_base = local_base
+        self.rclone_path = rclone_path
+        self.log_file = log_file
+        self.window = window
+        self.max_delay = max_delay
+        self.max_files = max_files
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rclone")
+        # (directory, job class) -> the files waiting out the batch window
+        self._pending = {}
+        # Batches ready to go, waiting for a free worker, and the workers each class holds
+        self._ready = []
+        self._active = {}
+        # Local path -> the running batch it is in, see cancel()
+        self._running = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="upload-batcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, local_path, job_class=None):
+        """
+        Queues a file for upload.
+
+        :param local_path: The path of the local file to be uploaded
+        :param job_class: The scheduling class of the file's job, files of different classes are batched apart
+        :return: A Future that completes with the file's size and the batch throughput once uploaded
+        """
+        future = Future()
         if not path.isfile(local_path):
-            raise ValueError(f"The local file {local_path} does not exist.")
-        if not remotes:
-            raise ValueError("The list of remotes cannot be empty.")
-        if not path.isdir(local_base):
-            raise ValueError(f"The local base directory {local_base} does not exist.")
-        if not path.isfile(state_file):
-            raise ValueError(f"The state file {state_file} does not exist.")
-        if not path.isfile(rclone_path):
-            raise ValueError(f"The rclone executable {rclone_path} does not exist.")
-
-        # Load the state file
-        with rclone_lock:
-            with open(state_file, "r") as f:
-                state = json.load(f)
-            index = state["index"]
-
-        # Choose the next remote in the list
-        remote = remotes[index]
-        index = (index + 1) % len(remotes)  # Increment the index and wrap around if needed
-
-        # Split the local path into its components and remove the part that corresponds to the local base directory
-        remote_path = path.relpath(path.dirname(local_path), local_base)
-        local_path = shlex.quote(local_path)
-        remote_path = path.join(remote, remote_path)
-        remote_path = shlex.quote(remote_path)
-
-        command = f"rclone move {local_path} {remote_path} -v --stats=5s --log-file {log_file}"
-        result = subprocess.run(command, shell=True, capture_output=True)
-        print(result.stdout)
-        print(result.stderr)
-
-        # Save the updated state
-        state = {"index": index}
-        with rclone_lock:
-            with open(state_file, "w") as f:
-                json.dump(state, f)
-
-    except Exception as e:
-        logging.error(f"An error occurred while uploading the file to the remote: {e}")
-        raise
\ No newline at end of file
+            future.set_exception(ValueError(f"The local file {local_path} does not exist."))
+            return future
+        directory = path.dirname(local_path)
+        with self._cond:
+            now = time.monotonic()
+            batch = self._pending.setdefault((directory, job_class), {"files": [], "first": now, "last": now})
+            batch["files"].append((path.basename(local_path), future))
+            batch["last"] = now
+            self._cond.notify()
+        return future
+
+    def cancel(self, local_path, reason):
+        """
+        Takes a file out of its upload. A file still waiting for its batch is dropped from it; a running
+        batch is stopped once every file in it was cancelled, otherwise it finishes for the other files.
+
+        :param local_path: The path passed to submit()
+        :param reason: Why, for the JobCancelled the file's future fails with
+        """
+        directory, name = path.dirname(local_path), path.basename(local_path)
+        dropped = []
+        with self._cond:
+            for key, batch in list(self._pending.items()):
+                if key[0] == directory:
+                    dropped += [entry for entry in batch["files"] if entry[0] == name]
+                    batch["files"] = [entry for entry in batch["files"] if entry[0] != name]
+                    if not batch["files"]:
+                        del self._pending[key]
+            for batch in self._ready:
+                if batch.directory == directory:
+                    dropped += [entry for entry in batch.files if entry[0] == name]
+                    batch.files[:] = [entry for entry in batch.files if entry[0] != name]
+            self._ready = [batch for batch in self._ready if batch.files]
+            running = self._running.get(local_path)
+            if running:
+                running["cancelled"].add(name)
+                if running["cancelled"] >= running["names"]:
+                    running["cancellation"].cancel(reason)
+        for _, future in dropped:
+            future.set_exception(JobCancelled(reason))
+
+    def flush(self):
+        """
+        Sends every waiting batch now instead of at the end of its window, to free disk space.
+        """
+        with self._cond:
+            for batch in self._pending.values():
+                batch["flush"] = True
+            self._cond.notify()
+
+    def set_workers(self, workers):
+        """
+        Changes how many batches are uploaded at once. Batches already running finish on the old pool.
+
+        :param workers: The new number of concurrent batches
+        """
+        with self._cond:
+            self.workers = workers
+            old, self._executor = self._executor, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rclone")
+            self._dispatch()
+        old.shutdown(wait=False)
+
+    def reschedule(self):
+        """
+        Starts whatever ready batches fit now, after the priorities or class limits changed.
+        """
+        with self._cond:
+            self._dispatch()
+
+    def _due(self, batch, now):
+        if len(batch["files"]) >= self.max_files or batch.get("flush"):
+            return 0
+        return min(batch["last"] + self.window, batch["first"] + self.max_delay) - now
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                ready = [key for key, batch in self._pending.items() if self._due(batch, now) <= 0]
+                if not ready:
+                    timeout = min((self._due(batch, now) for batch in self._pending.values()), default=None)
+                    self._cond.wait(timeout)
+                    continue
+                for directory, job_class in ready:
+                    files = self._pending.pop((directory, job_class))["files"]
+                    while files:
+                        self._ready.append(_ReadyBatch(job_class, now, directory, files[:self.max_files]))
+                        files = files[self.max_files:]
+                self._dispatch()
+
+    def _dispatch(self):
+        # Called with self._cond held. Hands ready batches to free workers, best first
+        while self._ready and sum(self._active.values()) < self.workers:
+            if self.priorities is None:
+                batch = self._ready[0]
+            else:
+                running = {("upload", job_class): count for job_class, count in self._active.items()}
+                batch = self.priorities.pick("upload", self._ready, running, time.monotonic())
+                if batch is None:
+                    return
+            self._ready.remove(batch)
+            self._active[batch.job_class] = self._active.get(batch.job_class, 0) + 1
+            running = {"names": {name for name, _ in batch.files}, "cancelled": set(), "cancellation": Cancellation()}
+            for name, _ in batch.files:
+                self._running[path.join(batch.directory, name)] = running
+            self._executor.submit(self._upload, batch, running["cancellation"])
+
+    def _upload(self, batch, cancellation):
+        try:
+            self._upload_batch(batch.directory, batch.files, cancellation)
+        finally:
+            with self._cond:
+                for name, _ in batch.files:
+                    self._running.pop(path.join(batch.directory, name), None)
+                self._active[batch.job_class] -= 1
+                self._dispatch()
+
+    def _upload_batch(self, directory, files, cancellation):
+        remote = None
+        sizes = {}
+        for name, future in files:
+            try:
+                sizes[name] = path.getsize(path.join(directory, name))
+            except OSError as e:
+                # Only this file's job fails, the rest of the batch is still uploaded
+                logging.error(f"Cannot upload {path.join(directory, name)}: {e}")
+                future.set_exception(e)
+        files = [(name, future) for name, future in files if name in sizes]
+        if not files:
+            return
+        try:
+            _check_rclone(self.local_base, self.rclone_path)
+            names = sorted(sizes)
+            size = sum(sizes.values())
+            remote = self.scheduler.acquire(size)
+            started = time.monotonic()
+            ok = False
+            with tempfile.NamedTemporaryFile("w", suffix=".files", delete=False) as f:
+                f.write("\n".join(names) + "\n")
+                files_from = f.name
+            try:
+                remote_path = path.join(remote, path.relpath(directory, self.local_base))
+                print(f"Uploading {len(names)} file(s) from {directory} to {remote_path}")
+                _rclone_move(self.rclone_path, directory, remote_path, self.log_file, files_from, run=cancellation.run)
+                ok = True
+            finally:
+                seconds = time.monotonic() - started
+                os.remove(files_from)
+                self.scheduler.release(remote, size, seconds, None if cancellation.cancelled else ok)
+                if self.metrics:
+                    self.metrics.record(None, "rclone_batch", seconds, ok=ok, remote=remote, files=len(names), bytes=size)
+        except JobCancelled as e:
+            print(f"Stopped uploading {directory}: {e}")
+            for _, future in files:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            logging.error(f"An error occurred while uploading {directory} to the remote: {e}")
+            for _, future in files:
+                future.set_exception(e)
+            return
+        if self.metrics:
+            self.metrics.increment("upload_bytes_total", size, remote=remote)
+        throughput = size / seconds if seconds > 0 else 0
+        for name, future in files:
+            future.set_result({"bytes": sizes[name], "throughput": round(throughput)})
+
+    def gauges(self):
+        """Return (name, labels, value) tuples for the files waiting to be batched, for JobMetrics."""
+        with self._cond:
+            pending = sum(len(batch["files"]) for batch in self._pending.values())
+            ready = len(self._ready)
+        return [("upload_pending_files", {}, pending), ("upload_batches_ready", {}, ready)]
@@ -0,0 +1,78 @@
+"""Disk-backed cache for TMDb and OMDb lookups.
+
+Entries are JSON documents keyed by a string such as ``tmdb:603`` or
+``omdb:tt0133093``. Each entry expires after a TTL, and once the cache holds
+more than `max_entries` the least recently used entries are evicted. Expired
+entries can still be read as stale values, which callers use as a hint
+about what a refresh will return.
+"""
+
+import json, os, sqlite3, threading, time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_used_at ON metadata (used_at);
+"""
+
+
+class MetadataCache:
+    """TTL and size-bounded cache of metadata lookups.
+
+    Arguments:
+        db_path (str): Where to keep the cache database.
+        ttl (float): Seconds an entry stays fresh.
+        max_entries (int): The number of entries kept before the least recently
+            used ones are evicted.
+    """
+
+    def __init__(self, db_path, ttl, max_entries):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        db = self._connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        """Look up an entry.
+
+        Returns:
+            tuple: The cached value (or None) and whether it is still fresh.
+        """
+        db = self._connection()
+        row = db.execute("SELECT value, fetched_at FROM metadata WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, False
+        with db:
+            db.execute("UPDATE metadata SET used_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), time.time() - row[1] < self.ttl
+
+    def put(self, key, value):
+        """Store an entry and evict the least recently used ones beyond `max_entries`."""
+        now = time.time()
+        with self._connection() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO metadata (key, value, fetched_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            db.execute(
+                "DELETE FROM metadata WHERE key IN "
+                "(SELECT key FROM metadata ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
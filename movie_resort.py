@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Re-sort movies that are already sorted, after the sorting rules change.
+
+Walks the movie trees under base_path (and the same trees on every rclone
+remote), looks each movie up on TMDb/OMDb through the metadata cache with a
+bounded number of concurrent, rate-limited lookups, and works out where the
+sorting rules would put it today. By default only the plan is printed:
+
+    python movie_resort.py --output plan.json
+
+With --execute (or --apply for a saved plan) the moves are made: local movie
+directories are renamed in parallel, the copies on the remotes are moved with
+rclone, and the old and new locations are refreshed on Plex, grouped so each
+directory is scanned once.
+
+Movie directories are recognised by their "Title (Year)" name. A
+"{tmdb-123}" or "{imdb-tt123}" tag in the name is used instead of a search.
+"""
+
+import argparse, errno, json, os, re, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from media_uploader import _rclone_move
+from metadata_cache import MetadataCache
+from movie_sorting import get_movie_data, find_movie, determine_movie_path, movie_directory, OMDB_URL
+from plex_operations import PlexClient, PlexRefreshCoalescer, plex_library, plex_path
+from sorting_rules import SortingRules
+from settings import load_settings
+import resilient_http
+
+MOVIE_NAME = re.compile(r"^(?P<title>.+?) \((?P<year>\d{4})\)(?P<tags>.*)$")
+TMDB_TAG = re.compile(r"\{tmdb-(\d+)\}")
+IMDB_TAG = re.compile(r"\{imdb-(tt\d+)\}")
+
+
+class RateLimit:
+    """Spaces calls at least 1/per_second seconds apart across threads."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _movie_dirs(root):
+    """Yield the movie directories under root, relative to it, without descending into them."""
+    for directory, subdirs, files in os.walk(root):
+        movies = [d for d in subdirs if MOVIE_NAME.match(d)]
+        subdirs[:] = [d for d in subdirs if d not in movies]
+        for movie in movies:
+            yield os.path.relpath(os.path.join(directory, movie), root)
+
+
+def _remote_path(remote, relative):
+    """The path of a directory relative to base_path on a remote, joined as media_uploader does."""
+    return os.path.join(remote, relative)
+
+
+def _remote_movie_dirs(rclone_path, remote, root):
+    location = _remote_path(remote, root)
+    result = subprocess.run([rclone_path, "lsf", "-R", "--dirs-only", location], capture_output=True, text=True)
+    if result.returncode == 3:
+        # The directory does not exist on this remote
+        return []
+    if result.returncode != 0:
+        print(f"Cannot list {location}: {result.stderr.strip()}")
+        return []
+    found = []
+    for line in sorted(result.stdout.splitlines()):
+        relative = line.rstrip("/")
+        parts = relative.split("/")
+        # Only the outermost directory that looks like a movie counts, as on the local walk
+        if MOVIE_NAME.match(parts[-1]) and not any(MOVIE_NAME.match(p) for p in parts[:-1]):
+            found.append(relative)
+    return found
+
+
+def discover(base_path, roots, remotes, rclone_path):
+    """Find the movies under each root, locally and on the remotes.
+
+    Returns:
+        dict: Movie directory relative to base_path -> the places it exists ("local" or a remote).
+    """
+    movies = {}
+    for root in roots:
+        if os.path.isdir(os.path.join(base_path, root)):
+            for relative in _movie_dirs(os.path.join(base_path, root)):
+                movies.setdefault(os.path.join(root, relative), []).append("local")
+        for remote in remotes:
+            for relative in _remote_movie_dirs(rclone_path, remote, root):
+                movies.setdefault(os.path.join(root, relative), []).append(remote)
+    return movies
+
+
+class Resorter:
+    """Builds and executes re-sort plans with the given Settings."""
+
+    def __init__(self, settings, workers, rate):
+        self.settings = settings
+        self.base_path = settings.base_path
+        self.uhd_dir = settings.uhd_base_path
+        self.movie_dir = settings.movie_base_path
+        self.remotes = settings.remotes
+        self.rclone_path = settings.rclone_path
+        self.workers = workers
+        self.rate = RateLimit(rate)
+        self.cache = MetadataCache(settings.metadata_cache_path, settings.metadata_cache_ttl, settings.metadata_cache_size)
+        self.sorting_rules = SortingRules(settings.sorting_rules)
+
+    def default_roots(self):
+        """Every top-level directory the sorting rules put HD or UHD movies in."""
+        roots = self.sorting_rules.roots(movie_directory(False, self.uhd_dir, self.movie_dir))
+        for root in self.sorting_rules.roots(movie_directory(True, self.uhd_dir, self.movie_dir)):
+            if root not in roots:
+                roots.append(root)
+        return roots
+
+    def _is_uhd(self, relative):
+        # Directories both trees sort into, like "Marvel and DC", cannot tell and count as HD
+        top = relative.split(os.sep)[0]
+        return top in (self.uhd_dir, movie_directory(True, self.uhd_dir, self.movie_dir)[1])
+
+    def _fresh(self, key):
+        return self.cache.get(key)[1]
+
+    def _lookup(self, relative):
+        name = os.path.basename(relative)
+        match = MOVIE_NAME.match(name)
+        tmdb_id = TMDB_TAG.search(name)
+        imdb_id = IMDB_TAG.search(name)
+        ids = {"tmdb_id": int(tmdb_id.group(1)), "imdb_id": imdb_id.group(1) if imdb_id else None} if tmdb_id else None
+        title, year = match.group("title"), int(match.group("year"))
+        if ids is None:
+            if not self._fresh(f"search:{title} ({year})"):
+                self.rate.wait()
+            ids = find_movie(title, year, self.settings.tmdb_api, self.cache, self.settings.tmdb_url)
+            if ids is None:
+                raise LookupError(f"No TMDb match for {title} ({year})")
+        if not self._fresh(f"tmdb:{ids['tmdb_id']}"):
+            self.rate.wait()
+        return get_movie_data(ids["tmdb_id"], ids["imdb_id"], self.settings.tmdb_api, self.settings.omdb_api,
+                              self.cache, self.settings.tmdb_url, self.settings.omdb_url or OMDB_URL)
+
+    def _target(self, relative):
+        movie_data = self._lookup(relative)
+        directories = movie_directory(self._is_uhd(relative), self.uhd_dir, self.movie_dir)
+        # determine_movie_path works on files; only the directory it picks above the movie is used,
+        # so the movie keeps its current directory name
+        target_file = determine_movie_path(movie_data, self.base_path, self.settings.plex_base_path,
+                                           os.path.join(self.base_path, relative, "movie"), directories, None,
+                                           self.sorting_rules)
+        parent = os.path.dirname(os.path.dirname(target_file))
+        return movie_data["collection"], os.path.relpath(os.path.join(parent, os.path.basename(relative)), self.base_path)
+
+    def plan(self, roots):
+        """Work out where every movie under roots belongs.
+
+        Returns:
+            dict: "moves" with source, destination and locations of each movie that should move,
+                and "errors" for movies that could not be looked up.
+        """
+        movies = discover(self.base_path, roots, self.remotes, self.rclone_path)
+        print(f"Found {len(movies)} movies, looking them up with {self.workers} workers")
+        sources = sorted(movies)
+        errors = []
+
+        def target(relative):
+            try:
+                return self._target(relative)
+            except Exception as e:
+                errors.append({"source": relative, "error": str(e)})
+                return None
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="resort") as pool:
+            targets = dict(zip(sources, pool.map(target, sources)))
+
+        # Keep collections together: every movie of a collection goes where its first movie goes
+        collection_parents = {}
+        moves = []
+        for source in sources:
+            if targets[source] is None:
+                continue
+            collection, destination = targets[source]
+            if collection:
+                key = (self._is_uhd(source), collection)
+                parent = collection_parents.setdefault(key, os.path.dirname(destination))
+                destination = os.path.join(parent, os.path.basename(source))
+            if os.path.normpath(destination) != os.path.normpath(source):
+                moves.append({"source": source, "destination": destination, "locations": movies[source]})
+        return {"moves": moves, "errors": errors}
+
+    def _prune(self, directory):
+        """Remove directories left empty by a move, up to the base path."""
+        base = os.path.normpath(self.base_path)
+        while os.path.normpath(directory) != base and os.path.commonpath([base, directory]) == base:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def _rename(self, move):
+        source = os.path.join(self.base_path, move["source"])
+        destination = os.path.join(self.base_path, move["destination"])
+        if os.path.exists(destination):
+            raise FileExistsError(f"{destination} already exists")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.rename(source, destination)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise OSError(f"{source} and {destination} are on different filesystems") from e
+            raise
+        self._prune(os.path.dirname(source))
+
+    def _remote_move(self, remote, move, log_file):
+        _rclone_move(self.rclone_path, _remote_path(remote, move["source"]), _remote_path(remote, move["destination"]), log_file,
+                     delete_empty_src_dirs=True)
+
+    def _parallel(self, fn, items, workers):
+        failed = []
+
+        def run(item):
+            try:
+                fn(*item)
+            except Exception as e:
+                failed.append((item, e))
+
+        with ThreadPoolExecutor(workers, thread_name_prefix="resort") as pool:
+            list(pool.map(run, items))
+        return failed
+
+    def execute(self, plan):
+        """Move the movies in a plan and refresh Plex. Returns the number of moves that failed."""
+        moves = plan["moves"]
+        local = [(m,) for m in moves if "local" in m["locations"]]
+        failed = self._parallel(self._rename, local, self.workers)
+        for (move,), e in failed:
+            print(f"Could not move {move['source']}: {e}")
+        failed_sources = {move["source"] for (move,), _ in failed}
+
+        log_file = self.settings.rclone_log_file + str(date.today()) + ".log"
+        remote_moves = [(remote, m, log_file) for m in moves if m["source"] not in failed_sources
+                        for remote in m["locations"] if remote != "local"]
+        remote_failed = self._parallel(self._remote_move, remote_moves, self.settings.upload_threads)
+        for (remote, move, _), e in remote_failed:
+            print(f"Could not move {move['source']} on {remote}: {e}")
+        failed_sources |= {move["source"] for (_, move, _), _ in remote_failed}
+
+        pending = {}
+        for move in moves:
+            if move["source"] in failed_sources:
+                continue
+            for relative in (os.path.dirname(move["source"]), move["destination"]):
+                directory = plex_path(os.path.join(self.base_path, relative), self.settings.plex_base_path, self.base_path)
+                library_id = plex_library(directory, self.settings.libraries)
+                if library_id is not None:
+                    pending.setdefault(library_id, {}).setdefault(directory, [])
+        if pending:
+            plex = PlexClient(self.settings.plex_server, self.settings.plex_token, self.workers)
+            PlexRefreshCoalescer(plex, 0, 0).flush(pending)
+        print(f"Moved {len(moves) - len(failed_sources)} of {len(moves)} movies")
+        return len(failed_sources)
+
+
+def print_plan(plan):
+    for move in plan["moves"]:
+        print(f"{move['source']} -> {move['destination']}  [{', '.join(move['locations'])}]")
+    for error in plan["errors"]:
+        print(f"Skipped {error['source']}: {error['error']}")
+    print(f"{len(plan['moves'])} movies to move, {len(plan['errors'])} could not be looked up")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="config/config.yaml")
+    parser.add_argument("--root", action="append", help="Directory under base_path to re-sort (default: every directory the sorting rules sort into)")
+    parser.add_argument("--output", help="Write the plan to this file")
+    parser.add_argument("--apply", help="Execute a plan written earlier with --output")
+    parser.add_argument("--execute", action="store_true", help="Execute the plan instead of only printing it")
+    parser.add_argument("--workers", type=int, help="Concurrent lookups and renames (default: api_threads)")
+    parser.add_argument("--rate", type=float, default=20, help="Most metadata lookups started per second")
+    args = parser.parse_args()
+
+    settings = load_settings(args.config)
+    resilient_http.configure(settings.http_services)
+    resorter = Resorter(settings, args.workers or settings.api_threads, args.rate)
+
+    if args.apply:
+        with open(args.apply) as f:
+            plan = json.load(f)
+    else:
+        plan = resorter.plan(args.root or resorter.default_roots())
+        print_plan(plan)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(plan, f, indent=2)
+    if args.apply or args.execute:
+        sys.exit(1 if resorter.execute(plan) else 0)
+
+
+if __name__ == "__main__":
+    main()
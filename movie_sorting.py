@@ -1,56 +1,167 @@
-import requests, pickle, shutil, traceback, os
-import pandas as pd
-from tmdbv3api import TMDb
-from tmdbv3api import Movie
-
-def get_movie_data(tmdb_id, imdb_id, tmdb_api, omdb_api):
-    def _get_tmdb_data(tmdb_id, tmdb_api):
-        tmdb = TMDb()
-        tmdb.api_key = tmdb_api
-        movie = Movie()
-        tmdb_data = movie.details(tmdb_id)
-        return tmdb_data
-
-    def _get_omdb_data(imdb_id, omdb_api):
-        if imdb_id is None:
-            return {}
-        omdb_data = requests.get(f"http://www.omdbapi.com/?apikey={omdb_api}&i={imdb_id}").json()
-        return omdb_data
-
-    tmdb_data = _get_tmdb_data(tmdb_id, tmdb_api)
-    omdb_data = _get_omdb_data(imdb_id, omdb_api)
-
-    missing_data = {}
-    production_companies = [company['name'] for company in tmdb_data.production_companies]
-    if not tmdb_data.production_companies:
-        missing_data['production_companies'] = omdb_data.get('Production')
-    if not tmdb_data.production_countries:
-        missing_data['production_countries'] = omdb_data.get('Country')
-    if not tmdb_data.spoken_languages:
-        missing_data['spoken_languages'] = omdb_data.get('Language')
-    genres = [genre['name'] for genre in tmdb_data.genres]
-    if not tmdb_data.genres:
-        missing_data['genres'] = omdb_data.get('Genre')
+import traceback, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from file_mover import FileMover
+import resilient_http
 
+OMDB_URL = "http://www.omdbapi.com/"
+
+_lookups = ThreadPoolExecutor(max_workers=4, thread_name_prefix="metadata")
+_movie_client = None
+_movie_client_key = None
+_default_mover = FileMover()
+_movie_client_lock = threading.Lock()
+
+# The fields OMDb can fill in when TMDb leaves them empty, and the OMDb key for each
+_OMDB_FIELDS = {
+    'production_companies': 'Production',
+    'production_countries': 'Country',
+    'spoken_languages': 'Language',
+    'genres': 'Genre',
+}
+
+def _get_movie_client(tmdb_api, tmdb_url=None):
+    global _movie_client, _movie_client_key
+    with _movie_client_lock:
+        # Rebuilt when the key or API root changes, so reloaded settings apply to the next lookup
+        if _movie_client is None or _movie_client_key != (tmdb_api, tmdb_url):
+            # Imported on first use, tmdbv3api is slow to import and most restarts never need it
+            from tmdbv3api import TMDb, Movie
+            tmdb = TMDb(session=resilient_http.session("tmdb"))
+            tmdb.api_key = tmdb_api
+            _movie_client = Movie()
+            if tmdb_url:
+                # tmdbv3api has no public option for the API root, used to point at a stand-in server
+                _movie_client._base = tmdb_url
+            _movie_client_key = (tmdb_api, tmdb_url)
+        return _movie_client
+
+def _get_tmdb_data(tmdb_id, tmdb_api, tmdb_url=None):
+    """Fetches a movie from TMDb and keeps only the fields the sorting uses, as plain JSON"""
+    tmdb_data = _get_movie_client(tmdb_api, tmdb_url).details(tmdb_id)
     try:
         title = tmdb_data.original_title
     except:
         title = tmdb_data.title
+    return {
+        'collection': tmdb_data.belongs_to_collection.name if tmdb_data.belongs_to_collection else None,
+        'production_companies': [company['name'] for company in tmdb_data.production_companies],
+        'production_countries': [{'name': country.get('name', '')} for country in tmdb_data.production_countries],
+        'spoken_languages': [{'english_name': language.get('english_name', '')} for language in tmdb_data.spoken_languages],
+        'genres': [genre['name'] for genre in tmdb_data.genres],
+        'title': title,
+        'release_date': tmdb_data.release_date,
+    }
+
+def _get_omdb_data(imdb_id, omdb_api, omdb_url=OMDB_URL):
+    return resilient_http.session("omdb").get(omdb_url, params={"apikey": omdb_api, "i": imdb_id}).json()
+
+def _omdb_values(omdb_data, field):
+    """Splits an OMDb field into the same shape TMDb uses for it"""
+    value = omdb_data.get(_OMDB_FIELDS[field])
+    if not value or value == 'N/A':
+        return None
+    values = [v.strip() for v in value.split(',')]
+    if field == 'production_countries':
+        return [{'name': v} for v in values]
+    if field == 'spoken_languages':
+        return [{'english_name': v} for v in values]
+    return values
+
+def _missing_fields(tmdb_data):
+    return [field for field in _OMDB_FIELDS if not tmdb_data[field]]
+
+def _cached(cache, key):
+    if cache is None:
+        return None, False
+    return cache.get(key)
+
+def get_movie_data(tmdb_id, imdb_id, tmdb_api, omdb_api, cache=None, tmdb_url=None, omdb_url=OMDB_URL):
+    """Collects the metadata used to sort a movie from TMDb, filling gaps from OMDb
+
+    OMDb is only asked when TMDb leaves a field empty. Both lookups are cached when
+    a cache is given, and when a stale TMDb entry already shows OMDb will be needed,
+    the two refreshes run concurrently.
+
+    Args:
+    tmdb_id (int): The TMDb id of the movie
+    imdb_id (str): The IMDb id of the movie, or None
+    tmdb_api (str): The TMDb API key
+    omdb_api (str): The OMDb API key
+    cache (MetadataCache): Optional cache of previous lookups
+    tmdb_url (str): Optional TMDb API root, for example "https://api.themoviedb.org/3"
+    omdb_url (str): The OMDb API URL
+
+    Returns:
+    dict: The movie's collection, companies, countries, languages, genres and names
+    """
+    tmdb_key, omdb_key = f"tmdb:{tmdb_id}", f"omdb:{imdb_id}"
+    tmdb_data, tmdb_fresh = _cached(cache, tmdb_key)
+    omdb_data, omdb_fresh = _cached(cache, omdb_key) if imdb_id else ({}, True)
+
+    tmdb_future = omdb_future = None
+    if not tmdb_fresh:
+        tmdb_future = _lookups.submit(_get_tmdb_data, tmdb_id, tmdb_api, tmdb_url)
+    if not omdb_fresh and tmdb_data and _missing_fields(tmdb_data):
+        omdb_future = _lookups.submit(_get_omdb_data, imdb_id, omdb_api, omdb_url)
+
+    if tmdb_future:
+        tmdb_data = tmdb_future.result()
+        if cache is not None:
+            cache.put(tmdb_key, tmdb_data)
+    missing = _missing_fields(tmdb_data)
+    if missing and not omdb_fresh and omdb_future is None:
+        omdb_future = _lookups.submit(_get_omdb_data, imdb_id, omdb_api, omdb_url)
+    if omdb_future:
+        omdb_data = omdb_future.result()
+        if cache is not None and omdb_data.get('Response') != 'False':
+            cache.put(omdb_key, omdb_data)
 
     data = {
-        'collection': tmdb_data.belongs_to_collection.name if tmdb_data.belongs_to_collection else None,
-        'production_companies': production_companies or missing_data.get('production_companies'),
-        'production_countries': tmdb_data.production_countries or missing_data.get('production_countries'),
-        'spoken_languages': tmdb_data.spoken_languages or missing_data.get('spoken_languages'),
-        'genres': genres or missing_data.get('genres'),
-        'movie_name': f"{title} ({tmdb_data.release_date[:4]})",
-        'title': title
+        'collection': tmdb_data['collection'],
+        'movie_name': f"{tmdb_data['title']} ({tmdb_data['release_date'][:4]})",
+        'title': tmdb_data['title']
     }
+    for field in _OMDB_FIELDS:
+        data[field] = tmdb_data[field] or (_omdb_values(omdb_data or {}, field) if field in missing else None) or []
 
     return data
 
 
-def determine_movie_path(tmdb_data, base_path, plex_movie_path, current_path, movie_directories):
+def _search_movie(title, year, tmdb_api, tmdb_url=None):
+    movies = _get_movie_client(tmdb_api, tmdb_url)
+    from tmdbv3api import Search
+    search = Search()
+    if tmdb_url:
+        search._base = tmdb_url
+    results = list(search.movies(title, year=year) if year else search.movies(title))
+    if not results:
+        return None
+    match = next((r for r in results if year and str(getattr(r, 'release_date', '')).startswith(str(year))), results[0])
+    return {'tmdb_id': match.id, 'imdb_id': movies.external_ids(match.id).get('imdb_id')}
+
+def find_movie(title, year, tmdb_api, cache=None, tmdb_url=None):
+    """Looks a movie up on TMDb by title and year, for movies that were sorted without their ids
+
+    Args:
+    title (str): The movie title
+    year (int): The release year, or None
+    tmdb_api (str): The TMDb API key
+    cache (MetadataCache): Optional cache of previous lookups
+    tmdb_url (str): Optional TMDb API root
+
+    Returns:
+    dict: The tmdb_id and imdb_id of the best match, or None if nothing matched
+    """
+    key = f"search:{title} ({year})"
+    found, fresh = _cached(cache, key)
+    if not fresh:
+        found = _search_movie(title, year, tmdb_api, tmdb_url)
+        if cache is not None:
+            cache.put(key, found)
+    return found
+
+
+def determine_movie_path(tmdb_data, base_path, plex_movie_path, current_path, movie_directories, plex_store, sorting_rules):
   """Set the movie path based on various metadata criteria
 
   Args:
@@ -59,6 +170,8 @@ def determine_movie_path(tmdb_data, base_path, plex_movie_path, current_path, mo
   plex_movie_path (str): The path on the plex server that all the movies are under
   current_path (str): The current path to the movie, including filename
   movie_directories (tup): The directory the movie is stored under [0] and the directory for the movies that cannot be classified [1]
+  plex_store (PlexStore): The local index of what is already on Plex, or None to sort by the rules alone
+  sorting_rules (SortingRules): The rules that pick the directory for movies not already on Plex
 
   Returns:
   str: The path the movie should be moved to based on the sorting criteria
@@ -79,118 +192,66 @@ def determine_movie_path(tmdb_data, base_path, plex_movie_path, current_path, mo
     else:
         return os.path.join(base_path, movie_directoy, *args, tmdb_data['movie_name'], file_name)
   
-  def _plex_data():
-    """Loads the plex data from the pkl files
+  def _local_path(plex_dir):
+    """Maps a directory on the Plex server back to the local directory, reversing plex_path()
     Args:
-    None
-    
+    plex_dir (str): A directory on the Plex server
+
     Returns:
-    tuple: movie dataframe and collections dataframe
+    str: The local directory, or None if plex_dir is not under the Plex movie path
     """
-    with open("data/movies_data.pkl", "rb") as f:
-      plex_movies_data = pickle.load(f)["data"]
-    with open("data/collections_data.pkl", "rb") as f:
-      plex_collections_data = pickle.load(f)
-    movies = pd.DataFrame(plex_movies_data)
-    collections = pd.DataFrame(plex_collections_data)
-    return movies, collections
-
-  production_company = tmdb_data.get('production_companies', '')
-  production_country = tmdb_data.get('production_countries', '')
-  language = tmdb_data.get('spoken_languages', '')
-  
-  production_company_set = set(production_company)
-  allowed_companies = {'Marvel Studios', 'DC Films', 'DC Studios'}
-  
-  plex_movies, plex_collections = _plex_data()
-  print("Plex Data loaded")
-  
-  # matching_collection = plex_collections.loc[plex_collections['name'] == tmdb_data['collection']]
-  # print(matching_collection)
-  # print("Checking if collections match")
-  # if not matching_collection.empty:
-  #   print("collection match")
-  #   collection_path = matching_collection['path'].iloc[0]
-  #   return _join_path(collection_path).replace(plex_movie_path, os.path.join(base_path, movie_directories[0]))
-  
-  # print("checking if exists on plex")
-  # if tmdb_data['movie_name'].isin(plex_movies['title'].values).any():
-  #   print("exists on plex")
-  #   new_path =  plex_movies.loc[plex_movies['title'] == tmdb_data['movie_name'], 'path'].iloc[0]
-  #   return new_path.replace(plex_movie_path, os.path.join(base_path, movie_directories[0])) 
-  
-  # print("Compared to Plex, no match")
-  print("Checking Genre's")
-  genre = tmdb_data.get('genres', [])
-  
-  if not genre:
-    print("No genre found")
-    return _join_path(base_path, movie_directories[1])
+    relative = os.path.relpath(plex_dir, plex_movie_path)
+    if relative.startswith(os.pardir):
+      return None
+    parts = relative.split(os.sep)
+    if parts[0] == "Sorted Movies":
+      parts[0] = movie_directories[0]
+    return os.path.join(base_path, *parts)
 
-  print("movie has a genre")
-  
-  if allowed_companies.intersection(production_company_set):
-    return _join_path(base_path, 'Marvel and DC')
-  
-  print("is not marvel or dc")
-  
-  if 'Philippines' in [x.get('name','') for x in production_country] or 'Tagalog' in [x.get('english_name','') for x in language]:
-      return _join_path(base_path, movie_directories[0], 'Filipino')
+  if plex_store is None:
+    rule, directory = sorting_rules.classify(tmdb_data, movie_directories)
+    print(f"Matched sorting rule {rule}: {directory}")
+    return _join_path(base_path, *directory.split('/'))
+
+  print("Checking if collections match")
+  collection_path = plex_store.collection_path(tmdb_data['collection']) if tmdb_data['collection'] else None
+  if collection_path and _local_path(collection_path):
+    print("collection match")
+    return os.path.join(_local_path(collection_path), tmdb_data['collection'], tmdb_data['movie_name'], file_name)
   
-  print ("is not filipino")
+  print("checking if exists on plex")
+  existing_path = plex_store.movie_path(tmdb_data['movie_name'])
+  if existing_path and _local_path(existing_path):
+    print("exists on plex")
+    return os.path.join(_local_path(existing_path), file_name)
   
-  if genre[0] == "TV Movie":
-    if len(genre) > 1 and genre[1] != 'TV Movie':
-      return _join_path(base_path, movie_directories[0], genre[1])
-    else:
-      return _join_path(base_path, movie_directories[0],'TV Movie')
-  elif 'Horror' in genre:
-      return _join_path(base_path, movie_directories[0],'Horror')
-  elif 'Animation' in genre:
-      return _join_path(base_path, movie_directories[0],'Animated')
-  elif 'Science Fiction' in genre: 
-      return _join_path(base_path, movie_directories[0],'SciFi')
-  elif 'Comedy' in genre and 'Romance' in genre:
-      return _join_path(base_path, movie_directories[0], 'RomCom')
-  else:
-      return _join_path(base_path, movie_directories[0], genre[0])
-  
-def move_movie(source_path, destination_path):
+  print("Compared to Plex, no match")
+  rule, directory = sorting_rules.classify(tmdb_data, movie_directories)
+  print(f"Matched sorting rule {rule}: {directory}")
+  return _join_path(base_path, *directory.split('/'))
+
+def move_movie(source_path, destination_path, mover=None):
   """Move a file from source_path to destination_path, creating the destination directory if it doesn't exist.
 
+  On the same filesystem this is a rename. Across filesystems the file is copied to a temporary name,
+  verified, fsynced and renamed into place before the source is removed, see FileMover.
+
   Args:
   source_path (str): The path of the file to be moved, including the file name.
   destination_path (str): The path where the file will be moved to, including the file name. The directory part of the path will be created if it doesn't exist.
+  mover (FileMover): The mover to use, which throttles copies per disk. A default one is used if not given.
 
   Returns:
   None
   """
   try:
-    # Ensure the destination directory exists
-    print(f"Making directory: {os.path.dirname(destination_path)}")
-    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-    print(f"Directory made: {os.path.dirname(destination_path)}")
-  except FileNotFoundError as e:
-    print(f"Error: The parent directory of {destination_path} does not exist")
-  except PermissionError as e:
-    print(f"Error: You do not have permission to create the directory {os.path.dirname(destination_path)}")
-  except Exception as e:
-    print(f"Error: An unexpected error occurred while creating the directory: {e}")
-    return
-  try:
-    # Move the file to the destination directory
     print(f"Moving file {source_path} to {destination_path}")
-    r = shutil.move(source_path, destination_path)
-    print(r)
-    print(f"File moved: {source_path}")
-  except FileNotFoundError as e:
-    print(f"Error: The file {source_path} does not exist")
-  except PermissionError as e:
-    print(f"Error: You do not have permission to move the file {source_path}")
+    method = (mover or _default_mover).move(source_path, destination_path)
+    print(f"File moved by {method}: {source_path}")
   except Exception as e:
-    print(f"Error: An unexpected error occurred while moving the file: {e}")
-    print("Stack trace:")
-    traceback.printexc()
+    print(f"Error: Could not move {source_path} to {destination_path}: {e}")
+    traceback.print_exc()
+    raise
 
 def movie_directory(isUHD, uhd_dir, movie_dir):
   """
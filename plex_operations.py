@@ -1,16 +1,178 @@
 from os import path
-import pickle, os
+import threading, time, requests
+from concurrent.futures import Future
 from datetime import datetime
-from plexapi.server import PlexServer
+import resilient_http
 
-def create_plex_server(server, token):
-  return PlexServer(server, token = token)
+def create_plex_server(server, token, session=None):
+  # Imported on first connection, plexapi is slow to import and the daemon may not need Plex for a while
+  from plexapi.server import PlexServer
+  timeout = getattr(session, "timeout", None)
+  return PlexServer(server, token = token, session = session, timeout = timeout)
+
+class PlexClient:
+  """Thread-safe Plex connection shared for the life of the process.
+
+  The PlexServer is created once on a keep-alive session with a connection pool,
+  and library sections are cached by id. If a request fails to connect, the
+  server and section cache are rebuilt and the call is retried once.
+
+  Args:
+  server (str): The Plex server URL
+  token (str): The Plex token
+  pool_size (int): The number of keep-alive connections to hold open
+  """
+
+  def __init__(self, server, token, pool_size=10):
+    self.url = server
+    self.token = token
+    self.pool_size = pool_size
+    self._lock = threading.Lock()
+    self._server = None
+    self._sections = {}
+
+  def _session(self):
+    return resilient_http.session("plex", self.pool_size)
+
+  def server(self):
+    with self._lock:
+      if self._server is None:
+        self._server = create_plex_server(self.url, self.token, self._session())
+      return self._server
+
+  def section(self, library_id):
+    """Returns the library section with the given id, fetching it only once"""
+    section = self._sections.get(library_id)
+    if section is None:
+      section = self.server().library.sectionByID(library_id)
+      self._sections[library_id] = section
+    return section
+
+  def reset(self):
+    with self._lock:
+      if self._server is not None:
+        self._server._session.close()
+      self._server = None
+      self._sections = {}
+
+  def run(self, fn):
+    """Calls fn(self), reconnecting and retrying once if Plex cannot be reached"""
+    try:
+      return fn(self)
+    except requests.exceptions.ConnectionError as e:
+      print(f"Lost connection to Plex ({e}), reconnecting")
+      self.reset()
+      return fn(self)
 
 def update_plex(library_id, directory, plex):
-  # Get the library with the specified ID
-  library = plex.library.sectionByID(library_id)
-  # Perform a partial update of the library
-  library.update(directory)
+  # Perform a partial update of the library with the specified ID
+  plex.run(lambda client: client.section(library_id).update(directory))
+
+def collapse_directories(directories):
+  """Drops duplicates and any directory that sits inside another one in the list
+
+  Args:
+  directories (iterable): Directories to refresh
+
+  Returns:
+  list: The minimal set of directories whose partial scans cover all of them
+  """
+  collapsed = []
+  for directory in sorted({path.normpath(d) for d in directories}):
+    if collapsed and path.commonpath([collapsed[-1], directory]) == collapsed[-1]:
+      continue
+    collapsed.append(directory)
+  return collapsed
+
+class PlexRefreshCoalescer:
+  """Gathers partial library refreshes and issues them in batches.
+
+  Requests are held until no new request has arrived for `window` seconds (but no
+  longer than `max_delay`), then duplicates and subdirectories of other pending
+  directories are dropped and one partial update is sent per remaining directory.
+  A season pack therefore costs one scan of the season folder instead of one per episode.
+  Every request gets a Future that completes once the partial update covering it has
+  been sent, or fails with the error Plex returned, so a job only counts as added to
+  Plex when it is.
+
+  Args:
+  plex (PlexClient): The Plex connection to refresh through
+  window (float): Seconds of quiet before pending refreshes are sent
+  max_delay (float): The longest a request is held back
+  metrics (JobMetrics): Optional sink for refresh timings
+  """
+
+  def __init__(self, plex, window, max_delay, metrics=None):
+    self.plex = plex
+    self.metrics = metrics
+    self.window = window
+    self.max_delay = max_delay
+    self._pending = {}
+    self._first = None
+    self._last = None
+    self._cond = threading.Condition()
+    self._thread = threading.Thread(target=self._run, name="plex-refresh", daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def request(self, library_id, directory):
+    """Queues a partial update of `directory` in library `library_id`
+
+    Returns:
+    Future: Completes with None once the update has been sent, or fails with its error
+    """
+    future = Future()
+    with self._cond:
+      now = time.monotonic()
+      self._pending.setdefault(library_id, {}).setdefault(directory, []).append(future)
+      self._first = self._first or now
+      self._last = now
+      self._cond.notify()
+    return future
+
+  def _due(self):
+    now = time.monotonic()
+    return min(self._last + self.window, self._first + self.max_delay) - now
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._pending or self._due() > 0:
+          self._cond.wait(self._due() if self._pending else None)
+        pending, self._pending = self._pending, {}
+        self._first = self._last = None
+      self.flush(pending)
+
+  def flush(self, pending):
+    """Sends the partial updates and completes the futures of the requests each one covers"""
+    for library_id, directories in pending.items():
+      errors = {}
+      for directory in collapse_directories(directories):
+        started = time.monotonic()
+        errors[directory] = None
+        try:
+          print(f"Refreshing Plex library {library_id}: {directory}")
+          update_plex(library_id, directory, self.plex)
+        except Exception as e:
+          errors[directory] = e
+          print(f"Plex refresh of {directory} failed: {e}")
+        if self.metrics:
+          self.metrics.record(None, "plex_refresh", time.monotonic() - started, ok=errors[directory] is None, library=library_id)
+      for directory, futures in directories.items():
+        directory = path.normpath(directory)
+        covering = next(d for d in errors if path.commonpath([d, directory]) == d)
+        for future in futures:
+          if errors[covering] is None:
+            future.set_result(None)
+          else:
+            future.set_exception(errors[covering])
+
+  def gauges(self):
+    """Returns (name, labels, value) tuples for the refreshes waiting to be sent, for JobMetrics"""
+    with self._cond:
+      pending = sum(len(futures) for directories in self._pending.values() for futures in directories.values())
+    return [("plex_refresh_pending", {}, pending)]
 
 def plex_library(media_path, libraries):
   for library in libraries:
@@ -23,46 +185,93 @@ def plex_path(media_path, plex_base, base_path):
     media_path = media_path.replace("4K Sorted", "Sorted Movies")
   return media_path.replace(base_path, plex_base)
 
-def get_plex_data(plex):
+def get_plex_data(plex, store, library_ids):
+  """Sync movies added since the last run and all collections into the local Plex store.
+
+  Args:
+  plex (PlexClient): The Plex connection to read from
+  store (PlexStore): The local index to update
+  library_ids (list): The library section ids to sync, non-movie libraries are skipped
+  """
   print("getting plex data")
-  movies_data = []
-  collections_data = []
-
-  try:
-    with open("data/movies_data.pkl", "rb") as f:
-      pkl_data = pickle.load(f)
-      movies_data = pkl_data['data']
-      last_updated = pkl_data['last_updated']
-      last_updated_date = datetime.fromtimestamp(last_updated).strftime("%Y-%m-%d")
-  except FileNotFoundError:
-    last_updated_date = "2000-01-01"
-  
-  
-  # Use the date in the search filter
-  for library_id in range(13, 35):
-    library = plex.library.sectionByID(library_id)
+  for library_id in library_ids:
+    library = plex.section(library_id)
+    if library.type != "movie":
+      continue
+    last_updated = store.last_updated(library_id) or 0
+    last_updated_date = datetime.fromtimestamp(last_updated).strftime("%Y-%m-%d") if last_updated else "2000-01-01"
+    synced_at = datetime.now().timestamp()
+    movies_data = []
     for movie in library.search(filters={"addedAt>>": last_updated_date}):
-      movie_data = {
+      movies_data.append({
+          'rating_key': str(movie.ratingKey),
           'title': f"{movie.title} ({movie.year})",
           'path': path.dirname(movie.locations[0]),
-          'addedAt': movie.addedAt,
-      }
-      movies_data.append(movie_data)
+          'added_at': movie.addedAt.timestamp() if movie.addedAt else None,
+      })
 
+    collections_data = []
     for collection in library.collections():
-      collection_data = {
+      collections_data.append({
         'name': collection.title,
         'path': library.locations[0]
-      }
-      collections_data.append(collection_data)
-
-    # Save the updated data to the cache files
-    with open("data/movies_data.pkl", "wb") as f:
-        pickle.dump({'data': movies_data, 'last_updated': datetime.now().timestamp()}, f)
-        f.close()
-    with open("data/collections_data.pkl", "wb") as f:
-        pickle.dump(collections_data, f)
-        f.close()
-        
+      })
+
+    store.update_library(library_id, movies_data, collections_data, synced_at)
+
   print("Plex Data grabbed")
 
+class PlexLibrarySyncer:
+  """Keeps the local Plex store up to date from a background thread.
+
+  Movie jobs only read the store, so the Plex scan is off their critical path.
+  A sync runs every `interval` seconds and whenever request_sync() is called.
+
+  Args:
+  plex (PlexClient): The Plex connection to sync from
+  store (PlexStore): The local index to update
+  libraries (list): The configured libraries, each with an "id"
+  interval (float): Seconds between periodic syncs
+  metrics (JobMetrics): Optional sink for sync timings
+  """
+
+  def __init__(self, plex, store, libraries, interval, metrics=None):
+    self.plex = plex
+    self.metrics = metrics
+    self.store = store
+    self.library_ids = [library["id"] for library in libraries]
+    self.interval = interval
+    # Set once the first sync attempt ends, so jobs do not sort against an empty store;
+    # synced tells whether any sync has succeeded
+    self.ready = threading.Event()
+    self.synced = False
+    self._wake = threading.Event()
+    self._thread = threading.Thread(target=self._run, name="plex-sync", daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def set_libraries(self, libraries):
+    """Sync these libraries from the next run on, and start that run now"""
+    self.library_ids = [library["id"] for library in libraries]
+    self.request_sync()
+
+  def request_sync(self):
+    """Ask for a sync as soon as the current one (if any) is done."""
+    self._wake.set()
+
+  def _run(self):
+    while True:
+      self._wake.clear()
+      started = time.monotonic()
+      ok = True
+      try:
+        self.plex.run(lambda client: get_plex_data(client, self.store, self.library_ids))
+        self.synced = True
+      except Exception as e:
+        ok = False
+        print(f"Plex library sync failed: {e}")
+      self.ready.set()
+      if self.metrics:
+        self.metrics.record(None, "plex_sync", time.monotonic() - started, ok=ok)
+      self._wake.wait(self.interval)
@@ -0,0 +1,129 @@
+"""Local SQLite index of the movies and collections on Plex.
+
+The index replaces the pickled lists that used to be rewritten in full on
+every sync. Movies are upserted by their Plex rating key, collections are
+replaced per library, and lookups by title or collection name use indexes.
+Each thread gets its own connection and the database runs in WAL mode, so
+a sync writes without blocking readers in other processes.
+
+Sorting jobs look movies and collections up in plain dicts loaded from the
+database on first use and dropped after every sync, so a lookup is a dict
+access rather than a query. The dicts are rebuilt outside any lock and
+swapped in whole, so lookups never wait for each other or for a rebuild.
+"""
+
+import os, sqlite3, threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    rating_key TEXT PRIMARY KEY,
+    library_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    path TEXT NOT NULL,
+    added_at REAL
+);
+CREATE INDEX IF NOT EXISTS movies_title ON movies (title);
+CREATE TABLE IF NOT EXISTS collections (
+    library_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (library_id, name)
+);
+CREATE INDEX IF NOT EXISTS collections_name ON collections (name);
+CREATE TABLE IF NOT EXISTS sync_state (
+    library_id INTEGER PRIMARY KEY,
+    last_updated REAL NOT NULL
+);
+"""
+
+
+class PlexStore:
+    """Indexed store of Plex movie and collection locations.
+
+    Arguments:
+        db_path (str): Where to keep the database.
+    """
+
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._index_lock = threading.Lock()
+        # (movies, collections), or None after a sync; replaced whole, never modified
+        self._indexes = None
+        self._generation = 0
+        db = self._connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(_SCHEMA)
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=30)
+            self._local.db = db
+        return db
+
+    def last_updated(self, library_id):
+        """Return the timestamp of the last sync of a library, or None."""
+        row = self._connection().execute(
+            "SELECT last_updated FROM sync_state WHERE library_id = ?", (library_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def update_library(self, library_id, movies, collections, synced_at):
+        """Upsert a library's new movies and replace its collections in one transaction.
+
+        Arguments:
+            library_id (int): The Plex library section id.
+            movies (list): Dicts with rating_key, title, path and added_at.
+            collections (list): Dicts with name and path.
+            synced_at (float): The timestamp to record as the library's last sync.
+        """
+        with self._connection() as db:
+            db.executemany(
+                "INSERT INTO movies (rating_key, library_id, title, path, added_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(rating_key) DO UPDATE SET library_id = excluded.library_id, title = excluded.title, "
+                "path = excluded.path, added_at = excluded.added_at",
+                [(m["rating_key"], library_id, m["title"], m["path"], m["added_at"]) for m in movies],
+            )
+            db.execute("DELETE FROM collections WHERE library_id = ?", (library_id,))
+            db.executemany(
+                "INSERT OR REPLACE INTO collections (library_id, name, path) VALUES (?, ?, ?)",
+                [(library_id, c["name"], c["path"]) for c in collections],
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO sync_state (library_id, last_updated) VALUES (?, ?)", (library_id, synced_at)
+            )
+        with self._index_lock:
+            self._generation += 1
+            self._indexes = None
+
+    def _index(self):
+        """Return the title and collection indexes, loading them if a sync dropped them."""
+        indexes = self._indexes
+        if indexes is not None:
+            return indexes
+        generation = self._generation
+        db = self._connection()
+        # Ascending, so the most recently added movie of a title is the one kept
+        movies = {title: path for title, path in db.execute(
+            "SELECT title, path FROM movies ORDER BY added_at IS NOT NULL, added_at")}
+        collections = {}
+        for name, path in db.execute("SELECT name, path FROM collections"):
+            collections.setdefault(name, path)
+        indexes = (movies, collections)
+        with self._index_lock:
+            # A sync that finished during the load may be missing from these, keep them for this lookup only
+            if self._generation == generation:
+                self._indexes = indexes
+        return indexes
+
+    def movie_path(self, title):
+        """Return the Plex directory of a movie titled "Title (Year)", or None."""
+        return self._index()[0].get(title)
+
+    def collection_path(self, name):
+        """Return the Plex library location holding a collection, or None."""
+        return self._index()[1].get(name)
@@ -0,0 +1,246 @@
+"""Shared HTTP sessions for Radarr, TMDb, OMDb and Plex with timeouts, rate limits, retries and circuit breaking.
+
+Every service gets one requests.Session subclass that all its clients use
+(pyarr, tmdbv3api and plexapi all accept a session). Each request:
+
+- gets the service's timeout unless the caller passed one, so a hung
+  endpoint cannot pin a worker forever;
+- takes a token from the service's bucket, so bursts of jobs stay under the
+  service's rate limit;
+- is retried on connection errors, timeouts, 429 and 5xx responses with
+  jittered exponential backoff, honouring Retry-After (only idempotent
+  methods are retried once the request may have reached the server);
+- goes through the service's circuit breaker. After `breaker_threshold`
+  consecutive failures the service is considered down and calls fail fast
+  with CircuitOpenError for `breaker_reset` seconds, after which one trial
+  request decides whether it is back.
+
+Settings per service come from DEFAULTS, overridden by the `http_services`
+section of config.yaml through configure().
+"""
+
+import random, threading, time
+import requests
+
+DEFAULTS = {
+    "timeout": 10,
+    "rate": None,
+    "burst": 10,
+    "retries": 3,
+    "backoff": 0.5,
+    "max_backoff": 30,
+    "breaker_threshold": 5,
+    "breaker_reset": 60,
+}
+
+SERVICE_DEFAULTS = {
+    "radarr": {"timeout": 5},
+    "tmdb": {"rate": 40, "burst": 40},
+    "omdb": {"rate": 10},
+    "plex": {"timeout": 30},
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """Fails calls fast after repeated failures, then lets one trial call through."""
+
+    def __init__(self, service, threshold, reset_after):
+        self.service = service
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def before(self):
+        """Raise CircuitOpenError if the call may not go out. Returns whether it is the trial call."""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_after and not self._trial:
+                self._trial = True
+                return True
+            raise CircuitOpenError(f"{self.service} is unavailable after {self.failures} consecutive failures")
+
+    def end_trial(self):
+        """Let another trial call through, after one that neither succeeded nor failed (a 429, an
+        unexpected error). Does nothing once success() or failure() resolved the trial."""
+        with self._lock:
+            self._trial = False
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                print(f"{self.service} is reachable again")
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    print(f"{self.service} failed {self.failures} times in a row, pausing calls for {self.reset_after}s")
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class ResilientSession(requests.Session):
+    """A requests.Session that applies one service's timeout, rate limit, retries and circuit breaker.
+
+    Arguments:
+        service (str): The service name, used in messages.
+        settings (dict): The service's settings, see DEFAULTS.
+        bucket (TokenBucket): The service's shared rate limit.
+        breaker (CircuitBreaker): The service's shared circuit breaker.
+        pool_size (int): Keep-alive connections to hold open per host.
+    """
+
+    def __init__(self, service, settings, bucket, breaker, pool_size=10):
+        super().__init__()
+        self.service = service
+        self.timeout = settings["timeout"]
+        self.retries = settings["retries"]
+        self.backoff = settings["backoff"]
+        self.max_backoff = settings["max_backoff"]
+        self.bucket = bucket
+        self.breaker = breaker
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def _delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # Full jitter keeps many jobs retrying the same outage from arriving in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        retryable = method.upper() in IDEMPOTENT
+        attempt = 0
+        while True:
+            trial = self.breaker.before()
+            try:
+                self.bucket.acquire()
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self.breaker.failure()
+                    sent = not isinstance(e, requests.exceptions.ConnectTimeout)
+                    if attempt >= self.retries or (sent and not retryable):
+                        raise
+                    delay = self._delay(attempt)
+                    print(f"{self.service} request failed ({e}), retrying in {delay:.1f}s")
+                else:
+                    if response.status_code not in RETRY_STATUS:
+                        self.breaker.success()
+                        return response
+                    # A 429 is the service pacing us, not failing, so it neither opens nor closes the circuit
+                    if response.status_code != 429:
+                        self.breaker.failure()
+                    if attempt >= self.retries or not retryable:
+                        return response
+                    delay = self._delay(attempt, response)
+                    print(f"{self.service} answered {response.status_code}, retrying in {delay:.1f}s")
+                    response.close()
+            finally:
+                if trial:
+                    self.breaker.end_trial()
+            attempt += 1
+            time.sleep(delay)
+
+
+_lock = threading.Lock()
+_settings = {}
+_policies = {}
+_sessions = {}
+
+
+def configure(services):
+    """Apply per-service overrides, for example the `http_services` section of config.yaml.
+
+    Arguments:
+        services (dict): Mapping of service name to a dict of settings from DEFAULTS.
+    """
+    with _lock:
+        for service, overrides in (services or {}).items():
+            unknown = set(overrides) - set(DEFAULTS)
+            if unknown:
+                raise ValueError(f"Unknown HTTP settings for {service}: {', '.join(sorted(unknown))}")
+            _settings[service] = dict(overrides)
+            _policies.pop(service, None)
+            _sessions.pop(service, None)
+
+
+def settings(service):
+    """Return the effective settings of a service."""
+    return {**DEFAULTS, **SERVICE_DEFAULTS.get(service, {}), **_settings.get(service, {})}
+
+
+def _policy(service):
+    if service not in _policies:
+        values = settings(service)
+        _policies[service] = (TokenBucket(values["rate"], values["burst"]),
+                              CircuitBreaker(service, values["breaker_threshold"], values["breaker_reset"]))
+    return _policies[service]
+
+
+def session(service, pool_size=10):
+    """Return the shared session of a service, creating it on first use."""
+    with _lock:
+        if service not in _sessions:
+            bucket, breaker = _policy(service)
+            _sessions[service] = ResilientSession(service, settings(service), bucket, breaker, pool_size)
+        return _sessions[service]
+
+
+def gauges():
+    """Return (name, labels, value) tuples for every service's circuit breaker, for JobMetrics."""
+    with _lock:
+        policies = dict(_policies)
+    samples = []
+    for service, (bucket, breaker) in policies.items():
+        samples.append(("http_circuit_open", {"service": service}, int(breaker.open)))
+        samples.append(("http_consecutive_failures", {"service": service}, breaker.failures))
+    return samples
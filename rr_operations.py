@@ -1,5 +1,5 @@
-from pyarr import RadarrAPI
 import requests
+import resilient_http
 
 def remove_movie_from_radarr(movie_id, radarr_api_url, api_key):
     """
@@ -13,15 +13,21 @@ def remove_movie_from_radarr(movie_id, radarr_api_url, api_key):
     Returns:
     None
     """
+    # pyarr is imported on first use, it is slow to import and only needed for movie jobs
+    from pyarr import RadarrAPI
+    from pyarr.exceptions import PyarrConnectionError
+
     # Connect to Radarr API
     print("connecting to Radarr")
     radarr = RadarrAPI(radarr_api_url, api_key)
+    # The shared session applies the timeout, rate limit, retries and circuit breaker
+    radarr.session = resilient_http.session("radarr")
     print("connected to Radarr")
-    # Set timeout for the API request
-    timeout = 5 # in seconds
-  
-    # Remove movie from Radarr and add to exclusion list
+    timeout = radarr.session.timeout
+
+    # Remove movie from Radarr and add to exclusion list. A CircuitOpenError is left to fail the
+    # job's step, so radarr_removed is not journaled for a movie that is still in Radarr
     try:
         radarr.del_movie(movie_id, delete_files=False, add_exclusion=True)
-    except requests.exceptions.Timeout as error:
-        print(f"Request Timeout: The API endpoint did not respond within {timeout} seconds.")
\ No newline at end of file
+    except (requests.exceptions.Timeout, PyarrConnectionError) as error:
+        print(f"Request Timeout: The API endpoint did not respond within {timeout} seconds.")
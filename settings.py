@@ -0,0 +1,323 @@
+"""Typed, validated settings loaded from config/config.yaml.
+
+The file is read once into an immutable Settings object. Every key is
+converted to its type and checked up front, and all problems are reported
+together, so a typo fails at startup rather than as a KeyError halfway
+through a job. Keys that older example files used under a different name
+are still accepted, with a warning.
+
+SettingsWatcher reloads the file on SIGHUP or when it changes on disk and
+hands the new Settings to its listeners, with the settings in
+RESTART_REQUIRED still at the values the process started with. A file that
+fails validation is reported and the running settings stay in effect.
+"""
+
+import os, signal, threading
+from dataclasses import MISSING, dataclass, field, fields, replace
+from types import MappingProxyType
+import yaml
+
+# Names the example config used to ship with, and the keys the code reads
+ALIASES = {
+    "uhd_radar_url": "uhd_radarr_url",
+    "uhd_directory": "uhd_base_path",
+    "movie_directory": "movie_base_path",
+}
+
+# Settings that only take effect after a restart, because they name files,
+# sockets or connections opened at startup, size pools created at startup, or
+# (base_path) are baked into the paths of the jobs and queues already running
+RESTART_REQUIRED = {
+    "plex_server", "plex_token", "sonarr_data", "radarr_data", "uhd_radarr_data", "spool_directory",
+    "journal_path", "metrics_log", "metrics_port", "plex_store_path", "metadata_cache_path",
+    "metadata_cache_ttl", "metadata_cache_size", "sorting_rules", "rclone_log_file", "rclone_state",
+    "remote_daily_quota", "remote_error_cooldown", "plex_pool_size", "move_copies_per_disk",
+    "move_verify", "convert_queue", "convert_lease", "radarr_concurrency", "metadata_concurrency",
+    "move_concurrency", "http_services", "base_path", "threads", "api_threads",
+}
+
+
+class SettingsError(ValueError):
+    """Raised when config.yaml is missing keys or has values of the wrong type."""
+
+
+@dataclass(frozen=True)
+class Settings:
+    plex_server: str
+    plex_token: str
+    radarr_url: str
+    uhd_radarr_url: str
+    radarr_api: str
+    uhd_radarr_api: str
+    sickbeard_path: str
+    rclone_log_file: str
+    rclone_state: str
+    tmdb_api: str
+    omdb_api: str
+    base_path: str
+    plex_base_path: str
+    uhd_base_path: str
+    movie_base_path: str
+    remotes: tuple
+    libraries: tuple
+    sonarr_data: str = None
+    radarr_data: str = None
+    uhd_radarr_data: str = None
+    spool_directory: str = "data/spool"
+    spool_poll_interval: float = 0.5
+    journal_path: str = "data/jobs.db"
+    metrics_log: str = "data/metrics.jsonl"
+    metrics_port: int = 0
+    plex_store_path: str = "data/plex.db"
+    metadata_cache_path: str = "data/metadata.db"
+    metadata_cache_ttl: float = 7 * 24 * 3600
+    metadata_cache_size: int = 10000
+    sorting_rules: str = "config/sorting_rules.yaml"
+    plex_sync_interval: float = 900
+    plex_sync_wait: float = 300
+    plex_refresh_window: float = 10
+    plex_refresh_max_delay: float = 60
+    python_path: str = "python3"
+    ffprobe_path: str = None
+    ffmpeg_path: str = "ffmpeg"
+    rclone_path: str = "rclone"
+    remote_daily_quota: int = None
+    remote_error_cooldown: float = 300
+    upload_batch_window: float = 15
+    upload_batch_max_delay: float = 120
+    upload_batch_max_files: int = 50
+    tmdb_url: str = None
+    omdb_url: str = None
+    move_copies_per_disk: int = 1
+    move_verify: str = "size"
+    staging_headroom: int = 0
+    staging_output_ratio: float = 1.0
+    staging_max_wait: float = 600
+    # Relative to base_path, so every host finds it on its own mount of base_path
+    convert_queue: str = None
+    convert_lease: float = 60
+    threads: int = 12
+    convert_threads: int = 2
+    # None means derived from another setting, see _derive()
+    upload_threads: int = None
+    api_threads: int = None
+    plex_pool_size: int = None
+    radarr_concurrency: int = 4
+    metadata_concurrency: int = None
+    move_concurrency: int = None
+    http_services: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+    job_priorities: MappingProxyType = field(default_factory=lambda: MappingProxyType({"tv": 10, "movie": 5, "uhd": 1}))
+    job_class_limits: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+    job_priority_aging: float = 300
+
+    def changed(self, other):
+        """Return the names of the settings that differ from other."""
+        return [f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name)]
+
+    def reloaded(self, new):
+        """Return new, with the settings in RESTART_REQUIRED kept at their values in self."""
+        return replace(new, **{name: getattr(self, name) for name in RESTART_REQUIRED})
+
+
+def _convert(name, kind, value):
+    if kind is str:
+        return str(value)
+    if kind in (int, float):
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            raise SettingsError(f"{name} must be a number, not {value!r}")
+    if kind is tuple:
+        if name == "libraries":
+            return _libraries(value)
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            raise SettingsError(f"{name} must be a list of strings")
+        return tuple(value)
+    if kind is MappingProxyType:
+        if not isinstance(value, dict):
+            raise SettingsError(f"{name} must be a mapping")
+        if name == "job_priorities":
+            return MappingProxyType({k: _convert(f"{name}.{k}", float, v) for k, v in value.items()})
+        if name == "job_class_limits":
+            if not all(isinstance(v, dict) for v in value.values()):
+                raise SettingsError(f"{name} must map each job class to a mapping of pool to limit")
+            return MappingProxyType({k: MappingProxyType({pool: _convert(f"{name}.{k}.{pool}", int, limit)
+                                                          for pool, limit in v.items()})
+                                     for k, v in value.items()})
+        return MappingProxyType({k: MappingProxyType(dict(v or {})) for k, v in value.items()})
+    return value
+
+
+def _libraries(value):
+    if not isinstance(value, list):
+        raise SettingsError("libraries must be a list of libraries with an id and a path")
+    libraries = []
+    for library in value:
+        if not isinstance(library, dict) or library.get("id") in (None, "") or not library.get("path"):
+            raise SettingsError(f"Every library needs an id and a path, got {library!r}")
+        try:
+            libraries.append(MappingProxyType({**library, "id": int(library["id"]), "path": str(library["path"])}))
+        except ValueError:
+            raise SettingsError(f"Library id must be a number, not {library['id']!r}")
+    return tuple(libraries)
+
+
+def _derive(values):
+    """Fill in the settings whose defaults depend on other settings."""
+    defaults = {
+        "upload_threads": len(values["remotes"]),
+        "api_threads": values["threads"],
+    }
+    for name, default in defaults.items():
+        if values[name] is None:
+            values[name] = default
+    for name in ("plex_pool_size", "metadata_concurrency", "move_concurrency"):
+        if values[name] is None:
+            values[name] = values["api_threads"]
+
+
+def parse_settings(config):
+    """Validate a config mapping and build Settings from it.
+
+    Arguments:
+        config (dict): The parsed config.yaml.
+
+    Raises:
+        SettingsError: Listing every missing key and invalid value.
+    """
+    config = dict(config or {})
+    for old, new in ALIASES.items():
+        if old in config:
+            if config.get(new) in (None, ""):
+                print(f"config.yaml: {old} is deprecated, rename it to {new}")
+                config[new] = config[old]
+            del config[old]
+
+    known = {f.name: f for f in fields(Settings)}
+    for name in sorted(set(config) - set(known)):
+        print(f"config.yaml: ignoring unknown setting {name}")
+
+    values, errors = {}, []
+    for name, spec in known.items():
+        value = config.get(name)
+        if value is None or value == "":
+            if spec.default is MISSING and spec.default_factory is MISSING:
+                errors.append(f"{name} is required")
+            elif spec.default_factory is not MISSING:
+                values[name] = spec.default_factory()
+            else:
+                values[name] = spec.default
+            continue
+        try:
+            values[name] = _convert(name, spec.type, value)
+        except SettingsError as e:
+            errors.append(str(e))
+
+    if not errors:
+        if not values["remotes"]:
+            errors.append("remotes must list at least one remote")
+        if values["move_verify"] not in ("size", "checksum"):
+            errors.append(f"move_verify must be size or checksum, not {values['move_verify']!r}")
+        for name in ("threads", "convert_threads", "upload_threads", "api_threads", "radarr_concurrency",
+                     "metadata_concurrency", "move_concurrency", "plex_pool_size", "move_copies_per_disk"):
+            if values[name] is not None and values[name] < 1:
+                errors.append(f"{name} must be at least 1")
+        for job_class, pools in values["job_class_limits"].items():
+            for pool, limit in pools.items():
+                if limit < 1:
+                    errors.append(f"job_class_limits.{job_class}.{pool} must be at least 1")
+        if values["staging_headroom"] < 0:
+            errors.append("staging_headroom cannot be negative")
+        if values["staging_output_ratio"] <= 0:
+            errors.append("staging_output_ratio must be more than 0")
+        if values["convert_lease"] <= 0:
+            errors.append("convert_lease must be more than 0")
+        if values["job_priority_aging"] < 0:
+            errors.append("job_priority_aging cannot be negative")
+    if errors:
+        raise SettingsError("Invalid config.yaml:\n  " + "\n  ".join(errors))
+    _derive(values)
+    return Settings(**values)
+
+
+def load_settings(path="config/config.yaml"):
+    """Read and validate a config file. Raises SettingsError or OSError."""
+    with open(path, "r") as f:
+        try:
+            config = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise SettingsError(f"{path} is not valid YAML: {e}")
+    return parse_settings(config)
+
+
+class SettingsWatcher:
+    """Reloads the settings on SIGHUP or when the file changes.
+
+    Arguments:
+        path (str): The config file.
+        settings (Settings): The settings currently in effect.
+        interval (float): Seconds between checks of the file's modification time.
+    """
+
+    def __init__(self, path, settings, interval=5):
+        self.path = path
+        self.current = settings
+        self.interval = interval
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._mtime = self._stat()
+        self._thread = threading.Thread(target=self._run, name="settings-watcher", daemon=True)
+
+    def subscribe(self, listener):
+        """Call listener(old, new) after every successful reload.
+
+        new has the reloaded values, except for RESTART_REQUIRED settings, which keep their old values.
+        """
+        self._listeners.append(listener)
+
+    def start(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self._wake.set())
+        self._thread.start()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _run(self):
+        while True:
+            requested = self._wake.wait(self.interval)
+            self._wake.clear()
+            mtime = self._stat()
+            if requested or mtime != self._mtime:
+                self._mtime = mtime
+                self.reload()
+
+    def reload(self):
+        """Load the file again and notify the listeners. Returns whether new settings were applied."""
+        with self._lock:
+            try:
+                new = load_settings(self.path)
+            except (SettingsError, OSError) as e:
+                print(f"Keeping the current settings, could not reload {self.path}: {e}")
+                return False
+            old, self.current = self.current, self.current.reloaded(new)
+        changed = new.changed(old)
+        if not changed:
+            return True
+        print(f"Reloaded {self.path}, changed: {', '.join(changed)}")
+        pending = sorted(set(changed) & RESTART_REQUIRED)
+        if pending:
+            print(f"These settings take effect after a restart: {', '.join(pending)}")
+        new = self.current
+        if not new.changed(old):
+            return True
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                print(f"Could not apply the new settings: {e}")
+        return True
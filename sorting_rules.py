@@ -0,0 +1,166 @@
+"""Declarative rules for the directory a movie is sorted into.
+
+The rules live in a YAML file (config/sorting_rules.yaml), are compiled once
+into set-based matchers and are evaluated with first-match semantics. The
+file is reloaded when its modification time changes, so adding a category is
+a config change. A file that fails to load is reported and the previous rules
+stay in effect.
+"""
+
+import os, threading
+import yaml
+
+FIELDS = ("genres", "production_companies", "production_countries", "spoken_languages")
+
+
+def _values(movie_data, field):
+    """Return a field of get_movie_data() as a tuple of plain strings."""
+    values = movie_data.get(field) or []
+    if field == "production_countries":
+        return tuple(v.get("name", "") if isinstance(v, dict) else v for v in values)
+    if field == "spoken_languages":
+        return tuple(v.get("english_name", "") if isinstance(v, dict) else v for v in values)
+    return tuple(values)
+
+
+def _compile_condition(field, condition):
+    if field not in FIELDS:
+        raise ValueError(f"Unknown field {field}")
+    checks = []
+    for op, arg in condition.items():
+        if op == "any":
+            wanted = frozenset(arg)
+            checks.append(lambda values, sets, wanted=wanted: not wanted.isdisjoint(sets[field]))
+        elif op == "all":
+            wanted = frozenset(arg)
+            checks.append(lambda values, sets, wanted=wanted: wanted <= sets[field])
+        elif op == "first":
+            checks.append(lambda values, sets, arg=arg: bool(values[field]) and values[field][0] == arg)
+        elif op == "empty":
+            checks.append(lambda values, sets, arg=bool(arg): (not values[field]) == arg)
+        else:
+            raise ValueError(f"Unknown condition {op} for {field}")
+    return checks
+
+
+def _compile_group(group):
+    checks = []
+    for field, condition in (group or {}).items():
+        checks.extend(_compile_condition(field, condition))
+    return lambda values, sets: all(check(values, sets) for check in checks)
+
+
+class _Rule:
+    def __init__(self, spec):
+        self.name = spec["name"]
+        self.directory = spec["directory"]
+        self.fallback = spec.get("fallback")
+        when = _compile_group(spec.get("when"))
+        if "when_any" in spec:
+            groups = [_compile_group(group) for group in spec["when_any"]]
+            self.matches = lambda values, sets: when(values, sets) and any(g(values, sets) for g in groups)
+        else:
+            self.matches = when
+
+    def directory_for(self, values, movie_directories):
+        fields = dict(values, movie_directory=movie_directories[0], unknown_directory=movie_directories[1])
+        try:
+            return self.directory.format(**fields)
+        except (IndexError, KeyError):
+            if self.fallback is None:
+                raise
+            return self.fallback.format(**fields)
+
+
+def compile_rules(specs):
+    """Compile a list of rule dicts, as found under `rules:` in the YAML file."""
+    rules = [_Rule(spec) for spec in specs]
+    if not rules:
+        raise ValueError("No sorting rules defined")
+    return rules
+
+
+class SortingRules:
+    """The compiled sorting rules, reloaded when the rules file changes.
+
+    Arguments:
+        path (str): The YAML rules file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._rules = None
+        self._reload()
+        if self._rules is None:
+            raise ValueError(f"Could not load sorting rules from {path}")
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            print(f"Cannot read sorting rules {self.path}: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.path) as f:
+                    self._rules = compile_rules(yaml.safe_load(f)["rules"])
+                print(f"Loaded {len(self._rules)} sorting rules from {self.path}")
+            except Exception as e:
+                print(f"Sorting rules in {self.path} are invalid, keeping the previous rules: {e}")
+            self._mtime = mtime
+
+    def roots(self, movie_directories):
+        """Return the top-level directories under base_path the rules can sort movies into.
+
+        Arguments:
+            movie_directories (tuple): The movie and unknown directories, from movie_directory().
+        """
+        self._reload()
+        fields = {"movie_directory": movie_directories[0], "unknown_directory": movie_directories[1]}
+        roots = []
+        for rule in self._rules:
+            for template in (rule.directory, rule.fallback):
+                if template is None:
+                    continue
+                try:
+                    root = template.format(**fields).split("/")[0]
+                except (IndexError, KeyError):
+                    # The top level depends on the movie, such as "{genres[0]}"
+                    continue
+                if root not in roots:
+                    roots.append(root)
+        return roots
+
+    def classify(self, movie_data, movie_directories):
+        """Find the directory for one movie.
+
+        Arguments:
+            movie_data (dict): Data from get_movie_data().
+            movie_directories (tuple): The movie directory and the directory for
+                movies that cannot be classified, from movie_directory().
+
+        Returns:
+            tuple: The name of the matching rule and the directory, relative to base_path.
+        """
+        return self.classify_many([movie_data], movie_directories)[0]
+
+    def classify_many(self, records, movie_directories):
+        """Classify a batch of get_movie_data() records with one snapshot of the rules."""
+        self._reload()
+        rules = self._rules
+        results = []
+        for movie_data in records:
+            values = {field: _values(movie_data, field) for field in FIELDS}
+            sets = {field: frozenset(v) for field, v in values.items()}
+            rule = next((rule for rule in rules if rule.matches(values, sets)), None)
+            if rule is None:
+                results.append((None, movie_directories[1]))
+            else:
+                results.append((rule.name, rule.directory_for(values, movie_directories)))
+        return results